@@ -16,6 +16,51 @@
 
 from math import *
 
+import numpy as np
+
+# Windows whose Poisson probability is below MIN_POISSON_PROB are outside of the scale of the window
+# scores; they are given the arbitrary score MAX_POISSON_SCORE.
+MIN_POISSON_PROB = 1e-250
+MAX_POISSON_SCORE = 1000
+
+
+def fact(m):
+    value = 1.0
+    if m != 0:
+        while m != 1:
+            value = value * m
+            m = m - 1
+    return value
+
+
+# Return the log of a factorial, using Srinivasa Ramanujan's approximation when m>=20
+def factln(m):
+    if m < 20:
+        return log(fact(m))
+    else:
+        return m * log(m) - m + log(m * (1 + 4 * m * (1 + 2 * m))) / 6.0 + log(pi) / 2
+
+
+def poisson(i, average):
+    if i < 20:
+        return exp(-average) * average ** i / fact(i)
+    else:
+        exponent = -average + i * log(average) - factln(i)
+        return exp(exponent)
+
+
+def poisson_values(size, average):
+    '''Returns the Poisson probabilities of the counts 0 to size - 1 for the mean average'''
+    return [poisson(i, average) for i in range(size)]
+
+
+def poisson_score_table(size, average):
+    '''Returns the window scores -log(Poisson(count, average)) of the counts 0 to size - 1, indexed by count.
+        The table is an object array, so that the capped scores keep being the integer MAX_POISSON_SCORE.'''
+    table = np.empty(size, dtype=object)
+    table[:] = [MAX_POISSON_SCORE if prob < MIN_POISSON_PROB else -log(prob) for prob in poisson_values(size, average)]
+    return table
+
 
 class Background_island_probscore_statistics:
     #  External genomeLength and gapSize are in units of bps
@@ -33,13 +78,12 @@ class Background_island_probscore_statistics:
         self.max_index = max(500, int(2 * self.average));
         # print self.average, self.max_index;
         # self.fact=[];
-        self.poisson_value = [];
+        self.poisson_value = poisson_values(self.max_index, self.average);
         self.window_score = [];
         self.window_scaled_score = [];
         for index in range(self.max_index):
             # self.fact.append(self.factorial(index));
-            prob = self.poisson(index, self.average);
-            self.poisson_value.append(prob);
+            prob = self.poisson_value[index];
             if (index < self.average):  # only want to look at enrichment
                 self.window_score.append(0);
                 self.window_scaled_score.append(0);
@@ -82,7 +126,7 @@ class Background_island_probscore_statistics:
         score = -log(self.poisson_value[self.min_tags_in_window]);
         # scaled_score = int(score/self.bin_size);
         scaled_score = int(round(score / self.bin_size));
-        self.island_expectation = [0] * (scaled_score + 1);
+        self.island_expectation = np.zeros(scaled_score + 1);
         self.island_expectation[scaled_score] = prob * self.genome_length;
 
         #       if len(self.island_expectation) < scaled_score:
@@ -95,31 +139,14 @@ class Background_island_probscore_statistics:
         # print "Exponent for Asymptotics: ", self.root;
 
     def factorial(self, m):
-        value = 1.0
-        if m != 0:
-            while m != 1:
-                value = value * m
-                m = m - 1
-        return value
+        return fact(m)
 
     # Return the log of a factorial, using Srinivasa Ramanujan's approximation
     def factln(self, m):
-        if m < 20:
-            value = 1.0
-            if m != 0:
-                while m != 1:
-                    value = value * m
-                    m = m - 1
-            return log(value)
-        else:
-            return m * log(m) - m + log(m * (1 + 4 * m * (1 + 2 * m))) / 6.0 + log(pi) / 2
+        return factln(m)
 
     def poisson(self, i, average):
-        if i < 20:
-            return exp(-average) * average ** i / self.factorial(i)
-        else:
-            exponent = -average + i * log(average) - self.factln(i)
-            return exp(exponent)
+        return poisson(i, average)
 
     """
         gap is in the unit of windows. In each window in the gap, the
@@ -161,35 +188,43 @@ class Background_island_probscore_statistics:
         return temp * temp  # start & end
 
     # forward method that memorize the calculated results.
+    # The expectation of a scaled score only depends on the expectations of scores lower by at least the scaled score
+    # of a window with min_tags_in_window tags, so blocks of that many scaled scores are computed at once. The
+    # terms of each score are added up as a running sum in increasing order of tag count.
     def background_island_expectation(self, scaled_score):
         current_max_scaled_score = len(self.island_expectation) - 1
         if scaled_score > current_max_scaled_score:
-            # index is the scaled_score
-            for index in range(current_max_scaled_score + 1, scaled_score + 1):
-                temp = 0.0
-                # i is the number of tags in the added window
-                i = self.min_tags_in_window
-                while (int(round(index - self.window_score[i] / self.bin_size)) >= 0):
-                    # while ( (index - self.window_scaled_score[i])>=0):
-                    temp += self.poisson_value[i] * self.island_expectation[
-                        int(round(index - self.window_score[i] / self.bin_size))]
-                    # temp += self.poisson_value[i]* self.island_expectation[index - self.window_scaled_score[i]];
-                    i += 1
-                temp *= self.gap_contribution
-                self.island_expectation.append(temp)
-                # print index, temp, self.island_expectation[index];
+            # i is the number of tags in the added window
+            i = np.arange(self.min_tags_in_window, self.max_index)
+            scaled_window_score = np.asarray(self.window_score, dtype=np.float64)[i] / self.bin_size
+            # Tag counts are taken in increasing order up to the first window scoring beyond scaled_score
+            beyond = np.flatnonzero(scaled_window_score > scaled_score + 1)
+            if len(beyond) > 0:
+                i = i[:beyond[0]]
+                scaled_window_score = scaled_window_score[:beyond[0]]
+            poisson_value = np.asarray(self.poisson_value, dtype=np.float64)[i]
+            block_size = max(int(scaled_window_score[0] - 0.5), 1) if len(i) > 0 else 1
+
+            expectation = np.concatenate((self.island_expectation, np.zeros(scaled_score - current_max_scaled_score)))
+            for first_index in range(current_max_scaled_score + 1, scaled_score + 1, block_size):
+                # index is the scaled_score
+                index = np.arange(first_index, min(first_index + block_size, scaled_score + 1))
+                if len(i) == 0:
+                    continue
+                previous = np.rint(index[:, None] - scaled_window_score[None, :]).astype(np.int64)
+                # Tag counts are added as long as the score without the added window is not negative
+                added = np.logical_and.accumulate(previous >= 0, axis=1)
+                terms = np.where(added, poisson_value * expectation[np.maximum(previous, 0)], 0.0)
+                expectation[index] = np.add.accumulate(terms, axis=1)[:, -1] * self.gap_contribution
+            self.island_expectation = expectation
         return self.island_expectation[scaled_score]
 
     def generate_cumulative_dist(self, outfile=""):
         """
         Generate cumulative distribution: a list of tuples (bins, hist).
         """
-        self.cumulative = [0] * len(self.island_expectation)
-        partial_sum = 0.0
-        for index in range(1, len(self.island_expectation) + 1):
-            complimentary = len(self.island_expectation) - index
-            partial_sum += self.island_expectation[complimentary]  # The end is outside of the index
-            self.cumulative[complimentary] = partial_sum
+        # The expectations are added up from the end of the distribution
+        self.cumulative = np.add.accumulate(self.island_expectation[::-1])[::-1]
 
         if outfile != "":
             fixpoint = int(len(self.island_expectation) / 2)
@@ -203,39 +238,48 @@ class Background_island_probscore_statistics:
                 outf.write(outline)
             outf.close()
 
-    def find_island_threshold(self, e_value_threshold):
+    def partial_cumulative(self, interval):
+        """
+        Returns the sum of the expectations of the last interval scaled scores but one, added up in order.
+        """
+        if len(self.island_expectation) > interval:
+            last_expectations = self.island_expectation[-interval: -1]
+        else:
+            last_expectations = self.island_expectation
+        if len(last_expectations) == 0:
+            return 0
+        return np.add.accumulate(last_expectations)[-1]
+
+    def find_island_thresholds(self, e_value_thresholds):
         """
         average is the average number of tags in a window:
         opt.tag_density * opt.window_size
 
         This one allows single-window islands.
-        Returns the island threshold
+        Returns the island threshold of every E-value of e_value_thresholds. The distribution is computed once,
+        as far as the smallest E-value requires.
         """
-        threshold = .0000001 * e_value_threshold
+        threshold = .0000001 * min(e_value_thresholds)
         current_scaled_score = len(self.island_expectation) - 1
-        current_expectation = self.island_expectation[-1]
-        assert (current_expectation == self.island_expectation[current_scaled_score]);
         interval = int(1 / self.bin_size)
-        if len(self.island_expectation) > interval:
-            partial_cumu = sum(self.island_expectation[-interval: -1])
-        else:
-            partial_cumu = sum(self.island_expectation)
+        partial_cumu = self.partial_cumulative(interval)
         while (partial_cumu > threshold or partial_cumu < 1e-100):
             current_scaled_score += interval
-            current_expectation = self.background_island_expectation(current_scaled_score)
-            if len(self.island_expectation) > interval:
-                partial_cumu = sum(self.island_expectation[-interval: -1])
-            else:
-                partial_cumu = sum(self.island_expectation)
-            # for index in  xrange(len(self.island_expectation)):
-            # print  index*self.bin_size, self.island_expectation[index];
+            self.background_island_expectation(current_scaled_score)
+            partial_cumu = self.partial_cumulative(interval)
 
         self.generate_cumulative_dist()
-        for index in range(len(self.cumulative)):
-            if self.cumulative[index] <= e_value_threshold:
-                score_threshold = index * self.bin_size
-                break
-        return score_threshold
+        score_thresholds = []
+        for e_value_threshold in e_value_thresholds:
+            index = int(np.flatnonzero(self.cumulative <= e_value_threshold)[0])
+            score_thresholds.append(index * self.bin_size)
+        return score_thresholds
+
+    def find_island_threshold(self, e_value_threshold):
+        """
+        Returns the island threshold for the E-value e_value_threshold
+        """
+        return self.find_island_thresholds([e_value_threshold])[0]
 
     def func(self, x):
         sum = 0.0
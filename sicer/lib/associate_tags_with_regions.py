@@ -16,14 +16,16 @@
 
 import bisect
 
+from sicer.lib import bed_parser
 
-def tag_position(line, fragment_size):
+
+def tag_position(read, fragment_size):
     shift = int(round(fragment_size / 2))
-    strand = line[5]
-    if strand == '+':
-        return int(line[1]) + shift
-    elif strand == '-':
-        return int(line[2]) - 1 - shift
+    strand = read['strand']
+    if strand == bed_parser.PLUS:
+        return int(read['start']) + shift
+    elif strand == bed_parser.MINUS:
+        return int(read['end']) - 1 - shift
 
 
 def find_readcount_on_islands(island_start_list, island_end_list, tag_position):
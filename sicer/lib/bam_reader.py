@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# Decoding of BAM alignment records into reads.
+#
+# The BGZF stream is decompressed in large chunks. A short Python loop walks
+# the record lengths to find where every record starts; all fields are then
+# gathered at once with NumPy from those offsets.
+#
+# Single-end reads match the output of `bedtools bamtobed`: unmapped records are
+# skipped, the end coordinate is given by the CIGAR, the name of a paired read
+# gets a /1 or /2 suffix and the score is the mapping quality.
+# In paired-end mode every properly ordered pair gives one fragment, taken from
+# its leftmost mate: it spans from the start of that mate to the end of the
+# other one (the template length), and its strand is the strand of the first mate.
+# When both mates start at the same position, the sign of the template length is
+# arbitrary and the fragment is taken from the first mate.
+#
+# When the BAM file has a .bai index, the records of a single chromosome can be
+# decoded on their own by seeking to the BGZF blocks listed in the index. The
+# linear index, which gives the first record of every 16 kb window, lets a range
+# of read starts (a shard of the chromosome) be decoded from its own blocks.
+
+import itertools
+import os
+import struct
+import sys
+
+import numpy as np
+
+from sicer.lib import bgzf
+from sicer.lib import bed_parser
+
+BAM_MAGIC = b'BAM\x01'
+BAI_MAGIC = b'BAI\x01'
+
+# Bin of the .bai index holding the file offsets and read counts of a reference instead of chunks
+METADATA_BIN = 37450
+
+# The windows of the linear index of a .bai index span 2**LINEAR_INDEX_SHIFT bp
+LINEAR_INDEX_SHIFT = 14
+
+FLAG_PAIRED = 0x1
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_MATE_REVERSE = 0x20
+FLAG_FIRST_MATE = 0x40
+FLAG_SECOND_MATE = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+# Bit i is set when CIGAR operation i (M, I, D, N, S, H, P, =, X) consumes the reference
+CIGAR_CONSUMES_REFERENCE = 0b110001101
+
+record_length = struct.Struct('<i')
+bin_header = struct.Struct('<Ii')
+
+
+def parse_header(data, file_name):
+    '''Parses the header at the start of the decompressed BAM data.
+        Returns the list of reference names and the offset of the first alignment record, or None if data
+        does not hold the complete header yet.'''
+    if len(data) >= 4 and data[:4] != BAM_MAGIC:
+        sys.stderr.write("Error: " + os.path.basename(file_name) + " is not a BAM file\n")
+        sys.exit(1)
+    if len(data) < 12:
+        return None
+    text_length = record_length.unpack_from(data, 4)[0]
+    position = 8 + text_length
+    if len(data) < position + 4:
+        return None
+    num_refs = record_length.unpack_from(data, position)[0]
+    position += 4
+    ref_names = []
+    for i in range(num_refs):
+        if len(data) < position + 4:
+            return None
+        name_length = record_length.unpack_from(data, position)[0]
+        if len(data) < position + 8 + name_length:
+            return None
+        ref_names.append(data[position + 4:position + 3 + name_length].decode())
+        position += 8 + name_length
+    return (ref_names, position)
+
+
+def read_header(infile, file_name):
+    '''Reads the header of the BAM file opened as infile. Returns the list of reference names.'''
+    data = b''
+    for chunk in bgzf.read_chunks(infile, chunk_size=1 << 16):
+        data += chunk
+        header = parse_header(data, file_name)
+        if header is not None:
+            return header[0]
+    sys.stderr.write("Error: The header of " + os.path.basename(file_name) + " is truncated\n")
+    sys.exit(1)
+
+
+def record_offsets(data, start=0):
+    '''Returns the offsets of the complete alignment records in data, starting at offset start,
+        and the offset where the first incomplete record begins.'''
+    offsets = []
+    position = start
+    size = len(data)
+    unpack = record_length.unpack_from
+    while position + 4 <= size:
+        next_position = position + 4 + unpack(data, position)[0]
+        if next_position > size:
+            break
+        offsets.append(position + 4)
+        position = next_position
+    return (np.array(offsets, dtype=np.int64), position)
+
+
+def gather_uint(buf, offsets, num_bytes):
+    '''Returns the little-endian unsigned integers of num_bytes bytes stored at offsets in buf.'''
+    values = np.zeros(len(offsets), dtype=np.uint32)
+    for k in range(num_bytes):
+        values |= buf[offsets + k].astype(np.uint32) << np.uint32(8 * k)
+    return values
+
+
+def gather_int32(buf, offsets):
+    return gather_uint(buf, offsets, 4).view(np.int32)
+
+
+def reference_lengths(buf, cigar_offsets, num_cigar_ops):
+    '''Returns the number of reference bases covered by the CIGAR of every record.'''
+    total_ops = int(num_cigar_ops.sum())
+    record_index = np.repeat(np.arange(len(cigar_offsets)), num_cigar_ops)
+    op_rank = np.arange(total_ops) - np.repeat(np.cumsum(num_cigar_ops) - num_cigar_ops, num_cigar_ops)
+    ops = gather_uint(buf, np.repeat(cigar_offsets, num_cigar_ops) + 4 * op_rank, 4)
+    consumed = np.where((CIGAR_CONSUMES_REFERENCE >> (ops & 0xF)) & 1, ops >> 4, 0)
+    return np.bincount(record_index, weights=consumed, minlength=len(cigar_offsets)).astype(np.int64)
+
+
+def read_names(buf, name_offsets, name_lengths):
+    names = np.zeros((len(name_offsets), 20), dtype=np.uint8)
+    for k in range(20):
+        inside = name_lengths > k
+        names[inside, k] = buf[name_offsets[inside] + k]
+    return names.view('S20').ravel()
+
+
+def parse_records(buf, offsets, ref_chrom_index, paired_end, with_names=False):
+    '''Converts the alignment records starting at offsets in buf (a uint8 array) into reads, with their names
+        and scores if with_names is True.
+        ref_chrom_index maps BAM reference ids to chromosome indices (-1 for chromosomes that are skipped).
+        Returns (chrom_index, reads) like bed_parser.parse_bed_block.'''
+    ref_id = gather_int32(buf, offsets)
+    flag = gather_uint(buf, offsets + 14, 2)
+    keep = (ref_id >= 0) & ((flag & FLAG_UNMAPPED) == 0)
+    if paired_end:
+        next_ref_id = gather_int32(buf, offsets + 20)
+        same_start = gather_int32(buf, offsets + 4) == gather_int32(buf, offsets + 24)
+        template_length = gather_int32(buf, offsets + 28)
+        keep &= (flag & FLAG_PAIRED) != 0
+        keep &= (flag & (FLAG_MATE_UNMAPPED | FLAG_SECONDARY | FLAG_SUPPLEMENTARY)) == 0
+        leftmost = np.where(same_start, (flag & FLAG_FIRST_MATE) != 0, template_length > 0)
+        keep &= (next_ref_id == ref_id) & (template_length != 0) & leftmost
+    keep[keep] = ref_chrom_index[ref_id[keep]] >= 0
+
+    offsets = offsets[keep]
+    flag = flag[keep]
+    chrom_index = ref_chrom_index[ref_id[keep]]
+    start = gather_int32(buf, offsets + 4).astype(np.int64)
+    name_length = buf[offsets + 8].astype(np.int64) - 1
+    mapq = buf[offsets + 9]
+
+    reads = np.empty(len(offsets), dtype=bed_parser.get_read_dtype(with_names))
+    reads['start'] = start
+    if paired_end:
+        reads['end'] = start + np.abs(template_length[keep])
+        reverse = np.where(flag & FLAG_FIRST_MATE, flag & FLAG_REVERSE, flag & FLAG_MATE_REVERSE)
+    else:
+        num_cigar_ops = gather_uint(buf, offsets + 12, 2).astype(np.int64)
+        reads['end'] = start + reference_lengths(buf, offsets + 33 + name_length, num_cigar_ops)
+        reverse = flag & FLAG_REVERSE
+    reads['strand'] = np.where(reverse, bed_parser.MINUS, bed_parser.PLUS)
+    if with_names:
+        names = read_names(buf, offsets + 32, name_length)
+        if not paired_end:
+            paired = (flag & FLAG_PAIRED) != 0
+            names = names.astype('S22')
+            for mate_flag, suffix in ((FLAG_FIRST_MATE, b'/1'), (FLAG_SECOND_MATE, b'/2')):
+                mate = paired & ((flag & mate_flag) != 0)
+                if mate.any():
+                    names[mate] = np.char.add(np.char.rstrip(names[mate], b'\x00'), suffix)
+        reads['name'] = names
+        reads['score'] = mapq
+    return (chrom_index, reads)
+
+
+def decode_chunks(chunks, ref_chrom_index, paired_end, file_name, skip_header=False, with_names=False):
+    '''Yields (chrom_index, reads) for the alignment records held in chunks of decompressed BAM data.
+        If skip_header is True, the data starts with the BAM header.'''
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk if pending else chunk
+        if skip_header:
+            header = parse_header(data, file_name)
+            if header is None:
+                pending = data
+                continue
+            data = data[header[1]:]
+            skip_header = False
+        offsets, complete = record_offsets(data)
+        pending = data[complete:]
+        if len(offsets) > 0:
+            yield parse_records(np.frombuffer(data, dtype=np.uint8), offsets, ref_chrom_index, paired_end, with_names)
+    if pending:
+        sys.stderr.write("Error: The last alignment record of " + os.path.basename(file_name) + " is truncated\n")
+        sys.exit(1)
+
+
+def read_bam_stream_blocks(infile, file_name, chroms, paired_end=False, with_names=False, chunk_size=1 << 24):
+    '''Yields (chrom_index, reads) for consecutive blocks of alignments of the BAM data read from the binary file
+        object infile, which is read once from its start and does not need to be seekable.
+        Reads on chromosomes that are not in chroms are skipped.'''
+    chrom_lookup = {chrom: i for i, chrom in enumerate(chroms)}
+    chunks = bgzf.read_chunks(infile, chunk_size=chunk_size)
+    data = b''
+    header = None
+    for chunk in chunks:
+        data += chunk
+        header = parse_header(data, file_name)
+        if header is not None:
+            break
+    if header is None:
+        sys.stderr.write("Error: The header of " + os.path.basename(file_name) + " is truncated\n")
+        sys.exit(1)
+    ref_chrom_index = np.array([chrom_lookup.get(name, -1) for name in header[0]], dtype=np.intp)
+    for block in decode_chunks(itertools.chain([data], chunks), ref_chrom_index, paired_end, file_name, True, with_names):
+        yield block
+
+
+def read_bam_blocks(path_to_file, chroms, paired_end=False, with_names=False, chunk_size=1 << 24):
+    '''Yields (chrom_index, reads) for consecutive blocks of alignments of the BAM file path_to_file.
+        Reads on chromosomes that are not in chroms are skipped.'''
+    with open(path_to_file, 'rb') as infile:
+        for block in read_bam_stream_blocks(infile, path_to_file, chroms, paired_end, with_names, chunk_size):
+            yield block
+
+
+def index_file_name(path_to_file):
+    '''Returns the path of the .bai index of the BAM file path_to_file (x.bam.bai or x.bai), or None if there is none'''
+    for index_file in (path_to_file + '.bai', path_to_file[:-len('.bam')] + '.bai'):
+        if os.path.isfile(index_file):
+            return index_file
+    return None
+
+
+def read_index(index_file):
+    '''Reads a .bai index. Returns, for every reference of the BAM file, the virtual offsets (begin, end) that
+        enclose its alignment records and its linear index, or None if the reference has no records.'''
+    with open(index_file, 'rb') as infile:
+        data = infile.read()
+    if data[:4] != BAI_MAGIC:
+        sys.stderr.write("Error: " + os.path.basename(index_file) + " is not a BAM index file\n")
+        sys.exit(1)
+    num_refs = record_length.unpack_from(data, 4)[0]
+    position = 8
+    regions = []
+    for ref in range(num_refs):
+        num_bins = record_length.unpack_from(data, position)[0]
+        position += 4
+        region = None
+        first = None
+        last = None
+        for i in range(num_bins):
+            bin_id, num_chunks = bin_header.unpack_from(data, position)
+            position += bin_header.size
+            chunks = np.frombuffer(data, dtype='<u8', count=2 * num_chunks, offset=position).reshape(-1, 2)
+            position += 16 * num_chunks
+            if bin_id == METADATA_BIN:
+                # The first pair of the metadata pseudo-bin spans all the records of the reference
+                region = (int(chunks[0, 0]), int(chunks[0, 1]))
+            elif num_chunks > 0:
+                first = int(chunks[:, 0].min()) if first is None else min(first, int(chunks[:, 0].min()))
+                last = int(chunks[:, 1].max()) if last is None else max(last, int(chunks[:, 1].max()))
+        if region is None and first is not None:
+            region = (first, last)
+        num_intervals = record_length.unpack_from(data, position)[0]
+        linear_index = np.frombuffer(data, dtype='<u8', count=num_intervals, offset=position + 4)
+        position += 4 + 8 * num_intervals
+        regions.append(None if region is None else (region, linear_index))
+    return regions
+
+
+def read_bam_chrom_blocks(path_to_file, index_file, chrom, paired_end=False, with_names=False, begin=None, end=None,
+                          chunk_size=1 << 24):
+    '''Yields the reads of chromosome chrom of the indexed BAM file path_to_file in read arrays.
+        Only the BGZF blocks of that chromosome, located through the index, are decompressed.
+        If begin or end is given, only the reads starting from begin to before end are yielded, and decompression
+        starts at the first window of the linear index that can hold them.'''
+    with open(path_to_file, 'rb') as infile:
+        ref_names = read_header(infile, path_to_file)
+        if chrom not in ref_names:
+            return
+        ref_id = ref_names.index(chrom)
+        ref_index = read_index(index_file)[ref_id]
+        if ref_index is None:
+            return
+        (region_begin, region_end), linear_index = ref_index
+        if begin is not None and begin > 0 and len(linear_index) > 0:
+            # Windows without records may hold 0 or the offset of an earlier window, never a later one
+            window = min(begin >> LINEAR_INDEX_SHIFT, len(linear_index) - 1)
+            region_begin = max(region_begin, int(linear_index[window]))
+        ref_chrom_index = np.full(len(ref_names), -1, dtype=np.intp)
+        ref_chrom_index[ref_id] = 0
+        chunks = bgzf.read_chunks(infile, region_begin, region_end, chunk_size)
+        for chrom_index, reads in decode_chunks(chunks, ref_chrom_index, paired_end, path_to_file, False, with_names):
+            if begin is not None:
+                reads = reads[reads['start'] >= begin]
+            if end is not None and len(reads) > 0 and reads['start'][-1] >= end:
+                # The records are sorted by position, so that no later read starts before end
+                yield reads[reads['start'] < end]
+                return
+            yield reads
+
+
+def read_bam_chrom(path_to_file, index_file, chrom, paired_end=False, with_names=False, chunk_size=1 << 24):
+    '''Returns the reads of chromosome chrom of the indexed BAM file path_to_file as a read array'''
+    reads = [np.empty(0, dtype=bed_parser.get_read_dtype(with_names))]
+    reads.extend(read_bam_chrom_blocks(path_to_file, index_file, chrom, paired_end, with_names, chunk_size=chunk_size))
+    return np.concatenate(reads)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Sidecar index of the chromosomes of a plain-text BED file.
+#
+# The index is only kept when a cache directory is given (--cache_dir), where it is
+# stored as <file>.<hash of its path>.sicer_index (JSON). For every chromosome it
+# records the byte ranges of the file holding its reads, the number of reads and
+# whether the reads are sorted by start coordinate. It is keyed by the size and
+# modification time of the BED file and ignored once the file changes.
+# With a valid index the reads of one chromosome are read by seeking to its byte
+# ranges instead of scanning the whole file. For sorted chromosomes the index also
+# records checkpoints, the offset and start of a read every CHECKPOINT_INTERVAL
+# reads, so that the reads of a range of starts (a shard of the chromosome, see
+# sicer.lib.chrom_scheduler) are read from the part of the file that holds them.
+
+from bisect import bisect_left
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+from sicer.lib import bed_parser
+
+INDEX_VERSION = 2
+
+# Beyond this number of byte ranges per chromosome the reads are considered too interleaved
+# for seeking to pay off, and only the read counts and sort flags are stored
+MAX_RANGES_PER_CHROM = 1024
+
+# Number of reads of a sorted chromosome between two checkpoints
+CHECKPOINT_INTERVAL = 1 << 16
+
+
+def index_file_name(path_to_file, cache_dir):
+    '''Returns the name of the index of the BED file path_to_file in cache_dir. Files of the same name in
+        different directories are told apart by the hash of their absolute path.'''
+    path_hash = hashlib.sha1(os.path.abspath(path_to_file).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, os.path.basename(path_to_file) + '.' + path_hash + '.sicer_index')
+
+
+def file_key(path_to_file):
+    stat = os.stat(path_to_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class ChromIndexBuilder:
+    '''Collects the index of a BED file from the blocks parsed by bed_parser.parse_block'''
+
+    def __init__(self, path_to_file, chroms):
+        self.path_to_file = path_to_file
+        self.key = file_key(path_to_file)
+        self.chroms = list(chroms)
+        self.ranges = [[] for chrom in chroms]
+        self.checkpoints = [[] for chrom in chroms]
+        self.read_counts = [0] * len(chroms)
+        self.is_sorted = [True] * len(chroms)
+        self.first_start = [None] * len(chroms)
+        self.last_start = [None] * len(chroms)
+        self.first_chrom = -1
+        self.last_chrom = -1
+
+    def add_block(self, block_offset, chrom_index, reads, line_starts, line_ends):
+        '''Adds the reads of a block found at byte block_offset of the file. line_starts and line_ends are the
+            offsets in the block of the line of every read.'''
+        if len(chrom_index) == 0:
+            return
+        # Runs of consecutive reads on the same chromosome
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(chrom_index)) + 1))
+        run_ends = np.append(run_starts[1:], len(chrom_index))
+        for first, last in zip(run_starts, run_ends):
+            i = int(chrom_index[first])
+            begin = block_offset + int(line_starts[first])
+            end = block_offset + int(line_ends[last - 1]) + 1
+            if i == self.last_chrom:
+                self.ranges[i][-1][1] = end
+            else:
+                self.ranges[i].append([begin, end])
+            if self.first_chrom < 0:
+                self.first_chrom = i
+            self.last_chrom = i
+
+            starts = reads['start'][first:last]
+            if self.is_sorted[i]:
+                if self.last_start[i] is not None and starts[0] < self.last_start[i]:
+                    self.is_sorted[i] = False
+                elif np.any(starts[1:] < starts[:-1]):
+                    self.is_sorted[i] = False
+            if self.first_start[i] is None:
+                self.first_start[i] = int(starts[0])
+            self.last_start[i] = int(starts[-1])
+            self.read_counts[i] += int(last - first)
+            if self.is_sorted[i]:
+                for k in range(0, last - first, CHECKPOINT_INTERVAL):
+                    self.checkpoints[i].append([block_offset + int(line_starts[first + k]), int(starts[k])])
+
+    def merge(self, other):
+        '''Adds the index collected by the builder other for the part of the file that directly follows
+            the part collected by this builder.'''
+        for i in range(len(self.chroms)):
+            ranges = other.ranges[i]
+            if ranges and i == self.last_chrom and i == other.first_chrom:
+                self.ranges[i][-1][1] = ranges[0][1]
+                ranges = ranges[1:]
+            self.ranges[i].extend(ranges)
+            self.checkpoints[i].extend(other.checkpoints[i])
+            if other.read_counts[i] == 0:
+                continue
+            if not other.is_sorted[i] or (self.last_start[i] is not None and other.first_start[i] < self.last_start[i]):
+                self.is_sorted[i] = False
+            if self.first_start[i] is None:
+                self.first_start[i] = other.first_start[i]
+            self.last_start[i] = other.last_start[i]
+            self.read_counts[i] += other.read_counts[i]
+        if self.first_chrom < 0:
+            self.first_chrom = other.first_chrom
+        if other.last_chrom >= 0:
+            self.last_chrom = other.last_chrom
+
+    def write(self, cache_dir):
+        '''Writes the index to cache_dir. A warning is printed if it cannot be written.'''
+        seekable = all(len(ranges) <= MAX_RANGES_PER_CHROM for ranges in self.ranges)
+        size = self.key['size']
+        index = {'version': INDEX_VERSION, 'file': self.key, 'chroms': {}}
+        for i, chrom in enumerate(self.chroms):
+            index['chroms'][chrom] = {
+                'reads': self.read_counts[i],
+                'sorted': self.is_sorted[i],
+                # The last line may lack its newline
+                'ranges': [[begin, min(end, size)] for begin, end in self.ranges[i]] if seekable else None,
+                'checkpoints': self.checkpoints[i] if seekable and self.is_sorted[i] else None}
+        # Written under a temporary name first so that concurrent runs never see a partial index
+        index_file = index_file_name(self.path_to_file, cache_dir)
+        try:
+            with open(index_file + '.' + str(os.getpid()), 'w') as outfile:
+                json.dump(index, outfile)
+            os.replace(outfile.name, index_file)
+        except OSError as error:
+            sys.stderr.write("Warning: The chromosome index of " + os.path.basename(self.path_to_file)
+                             + " cannot be written to " + cache_dir + ": " + str(error) + "\n")
+            return
+        print("Wrote the chromosome index of", os.path.basename(self.path_to_file), "to", index_file)
+
+
+def load_index(path_to_file, chroms, cache_dir):
+    '''Returns the index of the BED file path_to_file stored in cache_dir as a dictionary of chromosome entries,
+        or None if there is no index, if it is out of date or if it does not cover every chromosome in chroms.'''
+    try:
+        with open(index_file_name(path_to_file, cache_dir)) as infile:
+            index = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or index.get('file') != file_key(path_to_file):
+        return None
+    if any(chrom not in index['chroms'] for chrom in chroms):
+        return None
+    return index['chroms']
+
+
+def is_seekable(index, chroms, chrom_cuts=None):
+    '''Returns True if the reads of every chromosome in chroms can be read from their byte ranges. If chrom_cuts
+        is given, the chromosomes cut into shards must also have checkpoints to read the reads of every shard.'''
+    if index is None or any(index[chrom]['ranges'] is None for chrom in chroms):
+        return False
+    if chrom_cuts is None:
+        return True
+    return all(not cuts or index[chrom]['checkpoints'] is not None for chrom, cuts in zip(chroms, chrom_cuts))
+
+
+def start_ranges(entry, begin, end):
+    '''Returns the byte ranges of the index entry of a sorted chromosome that hold its reads starting from begin
+        to before end (either may be None)'''
+    checkpoint_starts = [start for offset, start in entry['checkpoints']]
+    byte_begin = 0
+    byte_end = None
+    if begin is not None:
+        # Reads starting at begin may follow a checkpoint at begin, but never one at a smaller start
+        k = bisect_left(checkpoint_starts, begin)
+        if k > 0:
+            byte_begin = entry['checkpoints'][k - 1][0]
+    if end is not None:
+        k = bisect_left(checkpoint_starts, end)
+        if k < len(checkpoint_starts):
+            byte_end = entry['checkpoints'][k][0]
+    ranges = []
+    for range_begin, range_end in entry['ranges']:
+        range_begin = max(range_begin, byte_begin)
+        if byte_end is not None:
+            range_end = min(range_end, byte_end)
+        if range_begin < range_end:
+            ranges.append([range_begin, range_end])
+    return ranges
+
+
+def range_blocks(infile, begin, end, block_size=1 << 24):
+    '''Yields line-aligned blocks of the bytes begin to end of the binary file object infile'''
+    def chunks():
+        infile.seek(begin)
+        remaining = end - begin
+        while remaining > 0:
+            chunk = infile.read(min(block_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    return bed_parser.line_blocks(chunks())
+
+
+def read_chrom_blocks(path_to_file, index, chrom, with_names=False, begin=None, end=None):
+    '''Yields the reads of chromosome chrom in blocks, reading only the byte ranges listed for it in index.
+        If begin or end is given, only the reads starting from begin to before end are yielded, and only the part
+        of the byte ranges that holds them is read if the chromosome is sorted.'''
+    ranges = index[chrom]['ranges']
+    in_range = begin is not None or end is not None
+    if in_range and index[chrom]['checkpoints'] is not None:
+        ranges = start_ranges(index[chrom], begin, end)
+    with open(path_to_file, 'rb') as infile:
+        for range_begin, range_end in ranges:
+            for block in range_blocks(infile, range_begin, range_end):
+                reads = bed_parser.parse_block(block, [chrom], path_to_file, with_names=with_names)[1]
+                if in_range:
+                    keep = np.ones(len(reads), dtype=bool)
+                    if begin is not None:
+                        keep &= reads['start'] >= begin
+                    if end is not None:
+                        keep &= reads['start'] < end
+                    reads = reads[keep]
+                yield reads
+
+
+def read_chrom(path_to_file, index, chrom, with_names=False):
+    '''Returns the reads of chromosome chrom by reading only the byte ranges listed for it in index'''
+    reads = [np.empty(0, dtype=bed_parser.get_read_dtype(with_names))]
+    reads.extend(read_chrom_blocks(path_to_file, index, chrom, with_names))
+    return np.concatenate(reads)
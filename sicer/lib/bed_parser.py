@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# Vectorized parsing of tab-delimited BED text.
+#
+# A block of raw bytes holding whole lines is tokenized with NumPy:
+# newline and tab positions give the field boundaries of every line at once,
+# integer columns are converted by weighting their digits with powers of ten
+# and string columns are gathered into fixed-width byte strings. No Python
+# code runs per line.
+
+import os
+import sys
+
+import numpy as np
+
+# Reads are stored per chromosome, so the chromosome is implied by the file or array holding them.
+# The strand is stored as the ASCII code of its character ('+' or '-'). The name and score columns
+# are only kept when the reads are written out again (--significant_reads).
+read_dtype = np.dtype([('start', np.int32), ('end', np.int32), ('strand', np.int8)])
+named_read_dtype = np.dtype([('start', np.int32), ('end', np.int32), ('strand', np.int8), ('name', 'S20'), ('score', np.int32)])
+
+PLUS = ord('+')
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+TAB = ord('\t')
+MINUS = ord('-')
+ZERO = ord('0')
+
+
+def get_read_dtype(with_names=False):
+    return named_read_dtype if with_names else read_dtype
+
+
+def bed_line(chrom, read):
+    '''Formats a read of chromosome chrom as a BED6 line. Reads stored without a name and score get "." and 0.'''
+    if 'name' in read.dtype.names:
+        name = read['name'].decode()
+        score = read['score']
+    else:
+        name = '.'
+        score = 0
+    return (chrom + '\t' + str(read['start']) + '\t' + str(read['end']) + '\t' + name + '\t' + str(score) + '\t'
+            + chr(read['strand']) + '\n')
+
+
+def read_blocks(infile, block_size=1 << 24):
+    '''Yields blocks of roughly block_size bytes read from the binary file object infile.
+        Every block ends at a line boundary.'''
+    return line_blocks(iter(lambda: infile.read(block_size), b''))
+
+
+def line_blocks(chunks):
+    '''Regroups the byte strings of the iterable chunks into blocks that end at a line boundary'''
+    remainder = b''
+    for block in chunks:
+        if remainder:
+            block = remainder + block
+        cut = block.rfind(b'\n') + 1
+        remainder = block[cut:]
+        if cut > 0:
+            yield block[:cut]
+    if remainder:
+        yield remainder + b'\n'
+
+
+def split_lines(buf):
+    '''Returns the start and (exclusive) end offsets of the non-empty lines in buf.
+        buf must end with a newline. Trailing carriage returns are excluded from the lines.'''
+    line_ends = np.flatnonzero(buf == NEWLINE)
+    line_starts = np.empty_like(line_ends)
+    line_starts[0:1] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    has_cr = np.zeros(len(line_ends), dtype=bool)
+    non_empty = line_ends > line_starts
+    has_cr[non_empty] = buf[line_ends[non_empty] - 1] == CARRIAGE_RETURN
+    line_ends = line_ends - has_cr
+    non_empty = line_ends > line_starts
+    return line_starts[non_empty], line_ends[non_empty]
+
+
+def split_fields(buf, line_starts, line_ends, num_fields):
+    '''Returns (field_starts, field_ends, fields_per_line) for the first num_fields tab-delimited fields
+        of every line. field_starts and field_ends are lists holding one offset array per field;
+        fields missing from a line are empty and located at the end of the line.'''
+    tabs = np.flatnonzero(buf == TAB)
+    first_tab = np.searchsorted(tabs, line_starts)
+    fields_per_line = np.searchsorted(tabs, line_ends) - first_tab + 1
+
+    complete = len(line_starts) == 0 or fields_per_line.min() >= num_fields
+    last_tab = max(len(tabs) - 1, 0)
+    field_starts = [line_starts]
+    field_ends = []
+    for k in range(num_fields):
+        if k > 0:
+            starts = field_ends[k - 1] + 1
+            if not complete:
+                np.minimum(starts, line_ends, out=starts)
+            field_starts.append(starts)
+        if complete and k < num_fields - 1:
+            # Every line has a tab after this field
+            field_ends.append(tabs[first_tab + k])
+        elif len(tabs) > 0:
+            field_ends.append(np.where(fields_per_line > k + 1, tabs[np.minimum(first_tab + k, last_tab)], line_ends))
+        else:
+            field_ends.append(line_ends)
+    return field_starts, field_ends, fields_per_line
+
+
+def fixed_width_field(buf, starts, ends, max_width=None):
+    '''Gathers the bytes buf[starts[i]:ends[i]] of every line into a fixed-width bytes array.
+        Fields longer than max_width are truncated.'''
+    width = int((ends - starts).max()) if len(starts) > 0 else 0
+    if max_width is not None:
+        width = min(width, max_width)
+    width = max(width, 1)
+    index = starts[:, None] + np.arange(width)
+    mask = index < ends[:, None]
+    chars = np.where(mask, buf[np.where(mask, index, 0)], 0).astype(np.uint8)
+    return np.ascontiguousarray(chars).view('S' + str(width)).ravel()
+
+
+def int_field(buf, starts, ends, file_name):
+    '''Converts the decimal integers buf[starts[i]:ends[i]] of every line into an integer array.'''
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    negative = np.zeros(len(starts), dtype=bool)
+    non_empty = ends > starts
+    negative[non_empty] = buf[starts[non_empty]] == MINUS
+    starts = starts + negative
+    lengths = ends - starts
+    width = int(lengths.max())
+    if lengths.min() <= 0 or width > 18:
+        sys.stderr.write("Error: Found an empty or out of range coordinate field in " + os.path.basename(file_name) + "\n")
+        sys.exit(1)
+    values = np.zeros(len(starts), dtype=np.int32 if width < 10 else np.int64)
+    # Digits are right-aligned: step k reads the digit of weight 10**(width-1-k) of every line.
+    # Positions left of a field are read as zero, which leaves the accumulated value unchanged.
+    invalid = np.zeros(len(starts), dtype=bool)
+    for k in range(width):
+        index = ends - (width - k)
+        outside = index < starts
+        digit = buf[np.maximum(index, 0)] - np.uint8(ZERO)
+        digit[outside] = 0
+        invalid |= digit > 9
+        values *= 10
+        values += digit
+    if invalid.any():
+        sys.stderr.write("Error: Found a non-integer coordinate or score field in " + os.path.basename(file_name) + "\n")
+        sys.exit(1)
+    values[negative] *= -1
+    return values
+
+
+def chrom_field_index(buf, starts, ends, chroms):
+    '''Returns the index in chroms of the chromosome name in buf[starts[i]:ends[i]] of every line,
+        or -1 if the name is not in chroms.'''
+    # Longer fields, such as track or comment lines, are truncated to one byte more than the longest name, so that
+    # they never match and do not widen the names of the whole block
+    names = fixed_width_field(buf, starts, ends, max((len(chrom.encode()) for chrom in chroms), default=0) + 1)
+    # Only chromosomes whose name fits in the widest field can match
+    candidates = [i for i, chrom in enumerate(chroms) if len(chrom.encode()) <= names.dtype.itemsize]
+    if not candidates:
+        return np.full(len(names), -1, dtype=np.intp)
+    table = np.array([chroms[i].encode() for i in candidates], dtype=names.dtype)
+    # Names are compared as 64 bit integers when they fit in 8 bytes, which is much faster than comparing strings
+    if names.dtype.itemsize <= 8:
+        names = names.astype('S8').view(np.uint64)
+        table = table.astype('S8').view(np.uint64)
+    order = np.argsort(table)
+    sorted_table = table[order]
+    position = np.minimum(np.searchsorted(sorted_table, names), len(table) - 1)
+    found = sorted_table[position] == names
+    return np.where(found, np.asarray(candidates)[order[position]], -1)
+
+
+def is_bedpe(file_name):
+    file_name = file_name.lower()
+    if file_name.endswith('.gz'):
+        file_name = file_name[:-len('.gz')]
+    return file_name.endswith('.bedpe')
+
+
+def parse_block(block, chroms, file_name, with_offsets=False, with_names=False):
+    '''Parses a block of the file file_name with parse_bedpe_block if it is a BEDPE file, or with parse_bed_block'''
+    if is_bedpe(file_name):
+        return parse_bedpe_block(block, chroms, file_name, with_offsets, with_names)
+    return parse_bed_block(block, chroms, file_name, with_offsets, with_names)
+
+
+def parse_bed_block(block, chroms, file_name, with_offsets=False, with_names=False):
+    '''Parses a block of BED6 lines into a read_dtype array, or a named_read_dtype array if with_names is True.
+        Returns (chrom_index, reads) where chrom_index holds, for every returned read, the index of its
+        chromosome in chroms. Lines whose chromosome is not in chroms are skipped.
+        If with_offsets is True, the start and end offsets in block of the line of every read are returned as well.'''
+    buf = np.frombuffer(block, dtype=np.uint8)
+    line_starts, line_ends = split_lines(buf)
+    field_starts, field_ends, fields_per_line = split_fields(buf, line_starts, line_ends, 6)
+
+    chrom_index = chrom_field_index(buf, field_starts[0], field_ends[0], chroms)
+    keep = chrom_index >= 0
+    if not keep.all():
+        chrom_index = chrom_index[keep]
+        line_starts = line_starts[keep]
+        line_ends = line_ends[keep]
+        fields_per_line = fields_per_line[keep]
+        field_starts = [starts[keep] for starts in field_starts]
+        field_ends = [ends[keep] for ends in field_ends]
+    if len(fields_per_line) > 0 and fields_per_line.min() < 6:
+        sys.stderr.write(
+            "Error: Input BED files must have the first six fields. Check " + os.path.basename(file_name) + " to see if it has the following fields: chrom, chromStart, chromEnd, name, score, and strand\n")
+        sys.exit(1)
+
+    reads = np.empty(len(chrom_index), dtype=get_read_dtype(with_names))
+    reads['start'] = int_field(buf, field_starts[1], field_ends[1], file_name)
+    reads['end'] = int_field(buf, field_starts[2], field_ends[2], file_name)
+    reads['strand'] = fixed_width_field(buf, field_starts[5], field_ends[5], 1).view(np.int8)
+    if with_names:
+        reads['name'] = fixed_width_field(buf, field_starts[3], field_ends[3], 20)
+        reads['score'] = int_field(buf, field_starts[4], field_ends[4], file_name)
+    if with_offsets:
+        return (chrom_index, reads, line_starts, line_ends)
+    return (chrom_index, reads)
+
+
+def parse_bedpe_block(block, chroms, file_name, with_offsets=False, with_names=False):
+    '''Parses a block of BEDPE lines into fragments, returned like the reads of parse_bed_block.
+        A pair whose mates lie on the same chromosome gives a fragment that spans from the start of the first mate
+        to the end of the second one, with the name, score and strand (of the first mate) of the pair.
+        Other pairs are skipped, as are pairs on chromosomes whose name does not contain "chr".'''
+    buf = np.frombuffer(block, dtype=np.uint8)
+    line_starts, line_ends = split_lines(buf)
+    field_starts, field_ends, fields_per_line = split_fields(buf, line_starts, line_ends, 9)
+
+    chrom_index = chrom_field_index(buf, field_starts[0], field_ends[0], chroms)
+    mate_chrom_index = chrom_field_index(buf, field_starts[3], field_ends[3], chroms)
+    # The last entry stands for the index -1 of unknown chromosomes
+    named_chr = np.array([('chr' in chrom) for chrom in chroms] + [False])
+    keep = (chrom_index >= 0) & (chrom_index == mate_chrom_index) & named_chr[chrom_index]
+    if not keep.all():
+        chrom_index = chrom_index[keep]
+        line_starts = line_starts[keep]
+        line_ends = line_ends[keep]
+        fields_per_line = fields_per_line[keep]
+        field_starts = [starts[keep] for starts in field_starts]
+        field_ends = [ends[keep] for ends in field_ends]
+    if len(fields_per_line) > 0 and fields_per_line.min() < 9:
+        sys.stderr.write(
+            "Error: Input BEDPE files must have the first nine fields. Check " + os.path.basename(file_name) + " to see if it has the following fields: chrom1, start1, end1, chrom2, start2, end2, name, score, and strand1\n")
+        sys.exit(1)
+
+    reads = np.empty(len(chrom_index), dtype=get_read_dtype(with_names))
+    reads['start'] = int_field(buf, field_starts[1], field_ends[1], file_name)
+    reads['end'] = int_field(buf, field_starts[5], field_ends[5], file_name)
+    reads['strand'] = fixed_width_field(buf, field_starts[8], field_ends[8], 1).view(np.int8)
+    if with_names:
+        reads['name'] = fixed_width_field(buf, field_starts[6], field_ends[6], 20)
+        reads['score'] = int_field(buf, field_starts[7], field_ends[7], file_name)
+    if with_offsets:
+        return (chrom_index, reads, line_starts, line_ends)
+    return (chrom_index, reads)
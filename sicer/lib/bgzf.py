@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Reader for BGZF, the blocked gzip format used by BAM files.
+#
+# A BGZF file is a series of gzip members of at most 64 KB each. The
+# compressed size of every member is stored in its header, so members can be
+# located without decompressing them. A position in the file is given as a
+# virtual offset: (compressed offset of the member << 16) | offset inside the
+# decompressed member.
+
+import struct
+import sys
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b\x08\x04'
+header_struct = struct.Struct('<4sI2BH')  # magic, mtime, extra flags, os, length of the extra field
+subfield_struct = struct.Struct('<2sH')
+
+
+def read_compressed_block(infile):
+    '''Reads the next BGZF member from infile without decompressing it.
+        Returns the raw deflate data and the total size of the member in the file, or (None, 0) at the end of the file.'''
+    header = infile.read(header_struct.size)
+    if len(header) == 0:
+        return (None, 0)
+    if len(header) < header_struct.size or header[:4] != GZIP_MAGIC:
+        sys.stderr.write("Error: " + getattr(infile, 'name', 'input') + " is not a BGZF compressed file\n")
+        sys.exit(1)
+    extra_length = header_struct.unpack(header)[4]
+    extra = infile.read(extra_length)
+    block_size = None
+    position = 0
+    while position + subfield_struct.size <= len(extra):
+        subfield_id, subfield_length = subfield_struct.unpack_from(extra, position)
+        if subfield_id == b'BC':
+            block_size = struct.unpack_from('<H', extra, position + subfield_struct.size)[0] + 1
+        position += subfield_struct.size + subfield_length
+    if block_size is None:
+        sys.stderr.write("Error: " + getattr(infile, 'name', 'input') + " is not a BGZF compressed file\n")
+        sys.exit(1)
+    remaining = infile.read(block_size - header_struct.size - extra_length)
+    # The member ends with the CRC32 and the size of the decompressed data
+    return (remaining[:-8], block_size)
+
+
+def decompress_block(compressed_data):
+    return zlib.decompress(compressed_data, -15)
+
+
+def read_chunks(infile, start_offset=None, end_offset=None, chunk_size=1 << 24):
+    '''Yields the decompressed content of a BGZF file in chunks of at least chunk_size bytes
+        (except for the last one). Reading starts at the virtual offset start_offset and stops before
+        the virtual offset end_offset, or at the end of the file if end_offset is None.
+        If start_offset is None, reading starts at the current position of infile, which then does not
+        need to be seekable.'''
+    block_address = 0
+    skip = 0
+    if start_offset is not None:
+        block_address = start_offset >> 16
+        skip = start_offset & 0xFFFF
+        infile.seek(block_address)
+    pieces = []
+    buffered = 0
+    while end_offset is None or block_address <= (end_offset >> 16):
+        compressed_data, block_size = read_compressed_block(infile)
+        if compressed_data is None:
+            break
+        data = decompress_block(compressed_data)
+        if end_offset is not None and block_address == (end_offset >> 16):
+            data = data[:end_offset & 0xFFFF]
+        if skip:
+            data = data[skip:]
+            skip = 0
+        block_address += block_size
+        if data:
+            pieces.append(data)
+            buffered += len(data)
+        if buffered >= chunk_size:
+            yield b''.join(pieces)
+            pieces = []
+            buffered = 0
+    if pieces:
+        yield b''.join(pieces)
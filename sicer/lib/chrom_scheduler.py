@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Packing of per-chromosome tasks into balanced work units.
+#
+# Every stage runs one task per chromosome. Assemblies made of thousands of small
+# contigs would then spend most of their time handing tiny tasks to the pool. The
+# chromosomes are weighted by their length and packed into work units: a chromosome
+# at least as long as the target unit weight is a unit of its own, and the smaller
+# ones are grouped until a unit reaches the target. Units are handed to the pool
+# heaviest first, one at a time, so that the processes stay balanced.
+#
+# Chromosomes much longer than the target unit weight would still finish last, and
+# leave processes idle when there are more of them than chromosomes. Stages that
+# can work on part of a chromosome cut such chromosomes into shards: ranges of read
+# starts whose boundaries are multiples of the window size. Reads starting before
+# the chromosome belong to its first shard and reads starting beyond it to its last.
+
+from functools import partial
+
+import numpy as np
+
+# Number of work units aimed at per process
+UNITS_PER_PROCESS = 4
+
+# Chromosomes are not cut into shards shorter than this many bp
+MIN_SHARD_LENGTH = 10000000
+
+
+def chrom_weights(args):
+    '''Returns the weight of every chromosome of args.species_chroms, its length'''
+    return [args.species_chrom_lengths.get(chrom, 0) for chrom in args.species_chroms]
+
+
+def make_work_units(weights, num_processes):
+    '''Groups the indices of weights into work units of similar total weight.
+        Returns the units, heaviest first.'''
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) == 0:
+        return []
+    target = weights.sum() / (max(num_processes, 1) * UNITS_PER_PROCESS)
+    units = []
+    unit_weights = []
+    current = []
+    current_weight = 0.0
+    for i in np.argsort(-weights, kind='stable'):
+        if current and current_weight + weights[i] > target:
+            units.append(current)
+            unit_weights.append(current_weight)
+            current = []
+            current_weight = 0.0
+        current.append(int(i))
+        current_weight += weights[i]
+    units.append(current)
+    unit_weights.append(current_weight)
+    order = np.argsort(-np.asarray(unit_weights), kind='stable')
+    return [units[k] for k in order]
+
+
+def run_work_unit(func, star, items):
+    if star:
+        return [func(*item) for item in items]
+    return [func(item) for item in items]
+
+
+def weighted_map(pool, func, items, weights, num_processes, star=False):
+    '''Same as pool.map(func, items) (pool.starmap if star is True). The items are processed in work units packed
+        by make_work_units according to their weights.'''
+    units = make_work_units(weights, num_processes)
+    unit_results = pool.map(partial(run_work_unit, func, star), [[items[i] for i in unit] for unit in units], chunksize=1)
+    results = [None] * len(items)
+    for unit, unit_result in zip(units, unit_results):
+        for i, result in zip(unit, unit_result):
+            results[i] = result
+    return results
+
+
+def chrom_map(pool, func, items, args, star=False):
+    '''Same as pool.map(func, items) (pool.starmap if star is True), where items holds one entry per chromosome of
+        args.species_chroms. The entries are processed in work units packed by make_work_units.'''
+    items = list(items)
+    weights = chrom_weights(args)
+    if len(weights) != len(items):
+        weights = [1] * len(items)
+    return weighted_map(pool, func, items, weights, args.cpu, star)
+
+
+def shard_length(args):
+    '''Returns the length of the shards of the chromosomes, a multiple of args.window_size'''
+    length = max(sum(chrom_weights(args)) // (max(args.cpu, 1) * UNITS_PER_PROCESS), MIN_SHARD_LENGTH)
+    return -(-length // args.window_size) * args.window_size
+
+
+def shard_cuts(chrom_length, length):
+    '''Returns the boundaries between the shards of a chromosome cut into shards of length bp. The last shard
+        takes the remainder, so that it is never shorter than half a shard.'''
+    num_shards = max(int(round(chrom_length / length)), 1)
+    return [k * length for k in range(1, num_shards)]
+
+
+def shard_of(starts, cuts):
+    '''Returns the shard of the reads with the given starts in a chromosome with boundaries cuts'''
+    return np.searchsorted(np.asarray(cuts, dtype=np.int64), starts, side='right')
+
+
+def shard_lengths(chrom_length, cuts):
+    '''Returns the length of every shard of a chromosome of chrom_length bp with boundaries cuts'''
+    boundaries = [0] + list(cuts) + [chrom_length]
+    return [boundaries[shard + 1] - boundaries[shard] for shard in range(len(cuts) + 1)]
+
+
+def shard_range(cuts, shard):
+    '''Returns (begin, end), the range of the starts of the reads of a shard of a chromosome with boundaries cuts.
+        begin is None for the first shard and end is None for the last one.'''
+    begin = cuts[shard - 1] if shard > 0 else None
+    end = cuts[shard] if shard < len(cuts) else None
+    return (begin, end)
+
+
+def shard_file_name(file_name, shard):
+    '''Returns the name under which the files of a shard of the library file_name are saved'''
+    return file_name + '_shard' + str(shard)
+
+
+def chrom_shards(args):
+    '''Returns the boundaries between the shards of every chromosome of args.species_chroms'''
+    length = shard_length(args)
+    return [shard_cuts(chrom_length, length) for chrom_length in chrom_weights(args)]
+
+
+def pool_size(args):
+    '''Returns the number of processes worth starting, at most one per shard'''
+    return max(min(args.cpu, sum(len(cuts) + 1 for cuts in chrom_shards(args))), 1)
+
+
+def shard_map(pool, func, args):
+    '''Calls func(chrom, shard, cuts) in the processes of pool for every shard of every chromosome of
+        args.species_chroms, where cuts are the boundaries between the shards of the chromosome (none if it is a
+        single shard). Returns, for every chromosome, the list of the results of its shards.'''
+    tasks = []
+    weights = []
+    chrom_lengths = chrom_weights(args)
+    for chrom, chrom_length, cuts in zip(args.species_chroms, chrom_lengths, chrom_shards(args)):
+        for shard, length in enumerate(shard_lengths(chrom_length, cuts)):
+            tasks.append((chrom, shard, cuts))
+            weights.append(length)
+    results = iter(weighted_map(pool, func, tasks, weights, args.cpu, star=True))
+    return [[next(results) for shard in range(len(cuts) + 1)] for cuts in chrom_shards(args)]
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Streaming decompression of gzip compressed text inputs (.bed.gz, .tagAlign.gz).
+#
+# Decompression runs in a background thread so that it overlaps with the parsing
+# done by the caller; zlib releases the GIL while it inflates. BGZF files (as
+# written by bgzip) are made of many small independent gzip members, which are
+# inflated in parallel by a pool of threads. Other gzip files are inflated as a
+# single stream. No decompressed copy of the input is written to disk.
+
+import collections
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from sicer.lib import bgzf
+
+
+def is_bgzf(path_to_file):
+    '''Returns True if the gzip file path_to_file is in BGZF format'''
+    with open(path_to_file, 'rb') as infile:
+        header = infile.read(bgzf.header_struct.size)
+        if len(header) < bgzf.header_struct.size or header[:4] != bgzf.GZIP_MAGIC:
+            return False
+        extra = infile.read(bgzf.header_struct.unpack(header)[4])
+    position = 0
+    while position + bgzf.subfield_struct.size <= len(extra):
+        subfield_id, subfield_length = bgzf.subfield_struct.unpack_from(extra, position)
+        if subfield_id == b'BC':
+            return True
+        position += bgzf.subfield_struct.size + subfield_length
+    return False
+
+
+def stream_chunks(infile, read_size=1 << 22):
+    '''Yields the decompressed content of the gzip file infile, which may hold several members.'''
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while True:
+        compressed_data = infile.read(read_size)
+        if not compressed_data:
+            break
+        while compressed_data:
+            data = decompressor.decompress(compressed_data)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # Start of the next gzip member
+            compressed_data = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def bgzf_chunks(infile, num_threads, blocks_per_chunk=256):
+    '''Yields the decompressed content of the BGZF file infile. Every chunk holds blocks_per_chunk members,
+        which are inflated by num_threads threads.'''
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = collections.deque()
+        finished = False
+        while not finished or pending:
+            if not finished:
+                batch = []
+                while len(batch) < blocks_per_chunk:
+                    compressed_data, block_size = bgzf.read_compressed_block(infile)
+                    if compressed_data is None:
+                        finished = True
+                        break
+                    batch.append(compressed_data)
+                if batch:
+                    pending.append([executor.submit(bgzf.decompress_block, block) for block in batch])
+            # Keep every thread busy with the next chunks while the oldest one is handed over
+            if pending and (finished or len(pending) > num_threads):
+                yield b''.join(future.result() for future in pending.popleft())
+
+
+def prefetch(chunks, depth=2):
+    '''Runs the generator chunks in a background thread, keeping up to depth items ready ahead of the caller.'''
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    failure = []
+
+    def produce():
+        try:
+            for item in chunks:
+                items.put(item)
+        except BaseException as error:
+            failure.append(error)
+        items.put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    thread.join()
+    if failure:
+        raise failure[0]
+
+
+def read_chunks(path_to_file, num_threads=1):
+    '''Yields the decompressed content of the gzip or BGZF file path_to_file in chunks, decompressing ahead
+        of the caller in a background thread.'''
+    def chunks():
+        with open(path_to_file, 'rb') as infile:
+            if num_threads > 1 and is_bgzf(path_to_file):
+                for chunk in bgzf_chunks(infile, num_threads):
+                    yield chunk
+            else:
+                for chunk in stream_chunks(infile):
+                    yield chunk
+    return prefetch(chunks())
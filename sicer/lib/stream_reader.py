@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Reading of libraries from a non-seekable stream such as standard input.
+#
+# A stream can only be read once, from the start. Its format is guessed from its
+# first bytes, which are kept and handed out again by the reader: BAM data starts
+# with a gzip member that inflates to the BAM magic number, other gzip data is
+# taken as compressed BED text and anything else as plain BED text.
+
+import zlib
+
+from sicer.lib import bam_reader
+from sicer.lib import bgzf
+
+# The first BGZF member of a BAM file is at most this long
+MAX_SNIFF_SIZE = 1 << 16
+
+
+class PeekableReader:
+    '''Binary reader over the stream infile that can look ahead at the first bytes without consuming them'''
+
+    def __init__(self, infile, name='stdin'):
+        self.infile = infile
+        self.name = name
+        self.head = b''
+
+    def peek(self, size):
+        '''Returns up to size bytes from the current position, fewer only if the stream ends first'''
+        while len(self.head) < size:
+            data = self.infile.read(size - len(self.head))
+            if not data:
+                break
+            self.head += data
+        return self.head[:size]
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.infile.read(size)
+        if size is None or size < 0:
+            data = self.head + self.infile.read()
+            self.head = b''
+            return data
+        data = self.head[:size]
+        self.head = self.head[size:]
+        if len(data) < size:
+            data += self.infile.read(size - len(data))
+        return data
+
+
+def sniff_format(reader):
+    '''Returns 'bam', 'gzip' or 'bed' for the content of the PeekableReader reader'''
+    head = reader.peek(MAX_SNIFF_SIZE)
+    if head[:2] != bgzf.GZIP_MAGIC[:2]:
+        return 'bed'
+    try:
+        data = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(head)
+    except zlib.error:
+        return 'gzip'
+    return 'bam' if data[:4] == bam_reader.BAM_MAGIC else 'gzip'
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Cumulative tag counts of a chromosome.
+#
+# The index of a chromosome holds, for every multiple i * INDEX_RESOLUTION of the
+# index resolution, the number of tags positioned before it. The tag count of any
+# interval whose ends are multiples of the resolution is then the difference of
+# two entries: windows of any size and sliding step that are multiples of the
+# resolution are counted in one subtraction per window, without going back to
+# the tags. The index also keeps the tag statistics printed for the chromosome.
+#
+# When a cache directory is given (--cache_dir), the index of every chromosome of
+# the treatment library is stored there as <file>.<hash>_<chrom>_tags.npz, where the
+# hash covers the path of the library, the fragment size and the redundancy
+# threshold, which all change the tags. It is keyed by the size and modification
+# time of the library and ignored once the library changes, so that later runs on
+# the same library at other window sizes take their window counts from the index.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Resolution of an index in bp. Window sizes and steps must be multiples of it.
+INDEX_RESOLUTION = 50
+
+
+def index_file_name(cache_dir, path_to_file, fragment_size, redundancy_threshold, chrom):
+    '''Returns the name of the tag index of chromosome chrom of the library path_to_file in cache_dir, or None
+        for a library read from standard input, which cannot be recognized in later runs'''
+    if path_to_file == '-':
+        return None
+    path_to_file = os.path.abspath(path_to_file)
+    library_hash = hashlib.sha1(json.dumps([path_to_file, fragment_size, redundancy_threshold]).encode()).hexdigest()
+    return os.path.join(cache_dir, os.path.basename(path_to_file) + '.' + library_hash[:16] + '_' + chrom + '_tags.npz')
+
+
+def library_key(path_to_file):
+    stat = os.stat(path_to_file)
+    return json.dumps({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+
+def bin_counts(positions, resolution=INDEX_RESOLUTION):
+    '''Returns (first_bin, counts), the tag counts of the bins of the given resolution from first_bin on'''
+    bins = np.asarray(positions, dtype=np.int64) // resolution
+    if len(bins) == 0:
+        return (0, np.zeros(0, dtype=np.int64))
+    first_bin = int(bins.min())
+    return (first_bin, np.bincount(bins - first_bin))
+
+
+def merge_bins(bins, chrom_length, resolution=INDEX_RESOLUTION):
+    '''Returns the tag counts of all the bins of a chromosome, the sum of the bin counts (first_bin, counts) in bins,
+        which cover tag positions less than chrom_length and may overlap each other'''
+    total_counts = np.zeros(-(-chrom_length // resolution), dtype=np.int64)
+    for first_bin, counts in bins:
+        total_counts[first_bin:first_bin + len(counts)] += counts
+    return total_counts
+
+
+def cumulative_counts(counts):
+    '''Returns the cumulative counts of the bin counts of a chromosome, starting with 0'''
+    cumulative = np.zeros(len(counts) + 1, dtype=np.uint32 if counts.sum() < 2**32 else np.uint64)
+    np.cumsum(counts, out=cumulative[1:])
+    return cumulative
+
+
+def save_index(index_file, path_to_file, counts, chrom_length, stats):
+    '''Saves the index of a chromosome of the library path_to_file, given by the bin counts of the chromosome and
+        stats, the tag statistics of the chromosome as a sequence of integers. Returns False if the index cannot be
+        written.'''
+    # Written under a temporary name first so that concurrent runs never see a partial index
+    temp_file = index_file + '.' + str(os.getpid())
+    try:
+        with open(temp_file, 'wb') as outfile:
+            np.savez_compressed(outfile, counts=counts.astype(np.uint32 if counts.max(initial=0) < 2**32 else np.uint64),
+                                chrom_length=chrom_length, stats=np.asarray(stats, dtype=np.int64),
+                                key=library_key(path_to_file))
+        os.replace(temp_file, index_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return False
+    return True
+
+
+def load_index(index_file, path_to_file, chrom_length):
+    '''Returns (cumulative, stats) for the index saved in index_file, or None if there is no index, if the library
+        path_to_file has changed since or if the index was built for another chromosome length'''
+    try:
+        with np.load(index_file) as index:
+            if str(index['key']) != library_key(path_to_file) or int(index['chrom_length']) != chrom_length:
+                return None
+            return (cumulative_counts(index['counts']), index['stats'].tolist())
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def is_valid_index(index_file, path_to_file, chrom_length):
+    '''Returns True if load_index would load the index saved in index_file, without reading its counts'''
+    try:
+        with np.load(index_file) as index:
+            return str(index['key']) == library_key(path_to_file) and int(index['chrom_length']) == chrom_length
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def interval_counts(cumulative, resolution, starts, ends):
+    '''Returns the number of tags in each interval [starts[i], ends[i]), whose ends must be multiples of the
+        resolution. Intervals are clipped to the chromosome.'''
+    last = len(cumulative) - 1
+    start_bins = np.clip(np.asarray(starts, dtype=np.int64) // resolution, 0, last)
+    end_bins = np.clip(np.asarray(ends, dtype=np.int64) // resolution, 0, last)
+    return cumulative[end_bins].astype(np.int64) - cumulative[start_bins]
+
+
+def window_counts(cumulative, chrom_length, window_size, step=None, resolution=INDEX_RESOLUTION):
+    '''Returns (window_starts, counts) for the windows of window_size bp starting every step bp (window_size by
+        default) that lie entirely within the chromosome'''
+    if step is None:
+        step = window_size
+    if window_size % resolution != 0 or step % resolution != 0:
+        raise ValueError("window size and step must be multiples of the index resolution " + str(resolution))
+    window_starts = np.arange(0, chrom_length - window_size + 1, step, dtype=np.int64)
+    return (window_starts, interval_counts(cumulative, resolution, window_starts, window_starts + window_size))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Typed storage of the window counts of a chromosome.
+#
+# A graph file holds one record per window containing tags: the start and end
+# coordinates of the window and its tag count, in order of position. The records
+# are saved as a plain structured NumPy array, so that graph files can be loaded
+# without unpickling, memory-mapped and processed with array operations by every
+# stage. Single-end windows end at start + window_size - 1, while the windows of
+# paired-end runs come from bedtools and end at start + bin_size, or at the end
+# of the chromosome; the ends are therefore stored rather than derived.
+
+import numpy as np
+
+window_dtype = [('start', np.int32), ('end', np.int32), ('count', np.uint32)]
+
+
+def graph_file_name(file_name, chrom, filtered=False):
+    '''Returns the name of the graph file of chromosome chrom of the library file_name (without .bed)'''
+    if filtered:
+        return file_name + '_' + chrom + '_filtered_graph.npy'
+    return file_name + '_' + chrom + '_graph.npy'
+
+
+def make_windows(starts, ends, counts):
+    '''Returns the window records for the arrays of window starts, ends and tag counts'''
+    windows = np.empty(len(starts), dtype=window_dtype)
+    windows['start'] = starts
+    windows['end'] = ends
+    windows['count'] = counts
+    return windows
+
+
+def save_windows(graph_file, windows):
+    np.save(graph_file, np.asarray(windows, dtype=window_dtype))
+
+
+def load_windows(graph_file, mmap=False):
+    '''Returns the window records of graph_file, memory-mapped if mmap is True. Files that are overwritten
+        while their windows are in use must not be memory-mapped.'''
+    if mmap:
+        try:
+            return np.load(graph_file, mmap_mode='r')
+        except ValueError:
+            # Files without any window cannot be memory-mapped by older NumPy versions
+            pass
+    return np.load(graph_file)
+
+
+def total_count(graph_file):
+    '''Returns the total tag count of the windows of graph_file'''
+    return int(load_windows(graph_file, mmap=True)['count'].sum(dtype=np.int64))
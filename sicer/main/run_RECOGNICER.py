@@ -10,6 +10,8 @@ import multiprocessing as mp
 curr_path = os.getcwd()
 
 # From SICER Package
+from sicer.lib import chrom_scheduler
+from sicer.src import demultiplex_reads_by_chrom
 from sicer.src import remove_redundant_reads
 from sicer.src import run_make_graph_file_by_chrom
 from sicer.src import coarsegraining
@@ -35,20 +37,23 @@ def main(args, df_run=False):  # df_run indicates if run_RECOGNICER is being cal
             "Temporary directory required for SICER cannot be created. Check if directories can be created in %s." % curr_path)
     try:
         # Step 0: create Pool object for parallel-Processing
-        num_chroms = len(args.species_chroms)
-        pool = mp.Pool(processes=min(args.cpu, num_chroms))
+        # Long chromosomes are processed in shards by some stages, so there may be more processes than chromosomes
+        pool = mp.Pool(processes=chrom_scheduler.pool_size(args))
 
         # Step 1: Remove redundancy reads in input file according to input threshold
-        treatment_file_name = os.path.basename(args.treatment_file)
+        treatment_file_name = demultiplex_reads_by_chrom.library_file_name(args.treatment_file)
         print("Preprocess the", treatment_file_name, "file to remove redundancy with threshold of",
               args.redundancy_threshold, "\n")
-        total_treatment_read_count = remove_redundant_reads.main(args, args.treatment_file, pool)
+        total_treatment_read_count = remove_redundant_reads.main(args, args.treatment_file, pool,
+                                                             args.significant_reads or args.rejected_reads)
+        # The tag index of the treatment library in the cache directory is named after its original path
+        args.treatment_path = args.treatment_file
         args.treatment_file = treatment_file_name
         print('\n')
 
         # Step 2: Remove redundancy reads in control library according to input threshold
         if (control_lib_exists):
-            control_file_name = os.path.basename(args.control_file)
+            control_file_name = demultiplex_reads_by_chrom.library_file_name(args.control_file)
             print("Preprocess the", control_file_name, "file to remove redundancy with threshold of",
                   args.redundancy_threshold, "\n")
             total_control_read_count = remove_redundant_reads.main(args, args.control_file, pool)
@@ -13,6 +13,8 @@ import multiprocessing as mp
 curr_path = os.getcwd()
 
 # From SICER Package
+from sicer.lib import chrom_scheduler
+from sicer.src import demultiplex_reads_by_chrom
 from sicer.src import remove_redundant_reads
 from sicer.src import run_make_graph_file_by_chrom
 from sicer.src import create_bed_windows
@@ -49,8 +51,8 @@ def main(args, df_run=False):
 
     try:
         # Step 0: create Pool object for parallel-Processing
-        num_chroms = len(args.species_chroms)
-        pool = mp.Pool(processes=min(args.cpu, num_chroms))
+        # Long chromosomes are processed in shards by some stages, so there may be more processes than chromosomes
+        pool = mp.Pool(processes=chrom_scheduler.pool_size(args))
 
         if args.paired_end == True:
 
@@ -59,17 +61,19 @@ def main(args, df_run=False):
             print("Creating bed windows based on pre-defined bin size %s (bp)... \n" % args.bin_size)
             create_bed_windows.main(args, pool) #make windows based on bin size
 
-            # Step 2-PE: Preprocess pe.bed file
-            treatment_file_name = os.path.basename(args.treatment_file)
-            print("Preprocess the", treatment_file_name, "file...\n") #separate bed to individual chroms
-            total_treatment_read_count = separate_bedpe_chroms.main(args, args.treatment_file, pool)
+            # Step 2-PE: Preprocess pe.bed file and remove redundant fragments according to input threshold
+            treatment_file_name = demultiplex_reads_by_chrom.library_file_name(args.treatment_file, True)
+            print("Preprocess the", treatment_file_name, "file to remove redundancy with threshold of",
+                  args.redundancy_threshold, "\n") #separate bed to individual chroms
+            total_treatment_read_count = separate_bedpe_chroms.main(args, args.treatment_file, pool, args.significant_reads)
             args.treatment_file = treatment_file_name
             print('\n')
 
             # Using the control graph file
             if control_lib_exists:
-                control_file_name = os.path.basename(args.control_file)
-                print("Preprocess the", control_file_name, "file...\n")
+                control_file_name = demultiplex_reads_by_chrom.library_file_name(args.control_file, True)
+                print("Preprocess the", control_file_name, "file to remove redundancy with threshold of",
+                      args.redundancy_threshold, "\n")
                 total_control_read_count = separate_bedpe_chroms.main(args, args.control_file, pool) #separate bed to individual chroms
                 args.control_file = control_file_name
 
@@ -87,16 +91,19 @@ def main(args, df_run=False):
         else:
             # Step 1-SE: Remove redundancy reads in input file according to input threshold
             # Output is the total number of reads retained. Represents size of library.
-            treatment_file_name = os.path.basename(args.treatment_file)
+            treatment_file_name = demultiplex_reads_by_chrom.library_file_name(args.treatment_file)
             print("Preprocess the", treatment_file_name, "file to remove redundancy with threshold of",
                   args.redundancy_threshold, "\n")
-            total_treatment_read_count = remove_redundant_reads.main(args, args.treatment_file, pool)
+            total_treatment_read_count = remove_redundant_reads.main(args, args.treatment_file, pool,
+                                                                 args.significant_reads or args.rejected_reads)
+            # The tag index of the treatment library in the cache directory is named after its original path
+            args.treatment_path = args.treatment_file
             args.treatment_file = treatment_file_name
             print('\n')
 
             # Step 2-SE: Remove redundancy reads in control library according to input threshold
             if control_lib_exists:
-                control_file_name = os.path.basename(args.control_file)
+                control_file_name = demultiplex_reads_by_chrom.library_file_name(args.control_file)
                 print("Preprocess the", control_file_name, "file to remove redundancy with threshold of",
                       args.redundancy_threshold, "\n")
                 total_control_read_count = remove_redundant_reads.main(args, args.control_file, pool)
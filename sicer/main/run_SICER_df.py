@@ -12,7 +12,9 @@ import multiprocessing as mp
 curr_path = os.getcwd()
 
 # From SICER Package
+from sicer.lib import chrom_scheduler
 from sicer.main import run_SICER
+from sicer.src import demultiplex_reads_by_chrom
 from sicer.src import find_union_islands
 from sicer.src import compare_two_libraries_on_islands
 from sicer.src import filter_islands_by_significance
@@ -52,13 +54,13 @@ def main(args):
             "Temporary directory required for SICER_df cannot be created. Check if directories can be created in %s."
             % curr_path)
     try:
-        num_chroms = len(args.species_chroms)
-        pool = mp.Pool(processes=min(args.cpu, num_chroms))
+        # Long chromosomes are processed in shards by some stages, so there may be more processes than chromosomes
+        pool = mp.Pool(processes=chrom_scheduler.pool_size(args))
 
         # Find the union island between two treatment files. It will generate a summary file
         print("\n")
-        args.treatment_file[0] = os.path.basename(args.treatment_file[0])
-        args.treatment_file[1] = os.path.basename(args.treatment_file[1])
+        args.treatment_file[0] = demultiplex_reads_by_chrom.library_file_name(args.treatment_file[0])
+        args.treatment_file[1] = demultiplex_reads_by_chrom.library_file_name(args.treatment_file[1])
         print("Finding all the union islands of ", args.treatment_file[0], "and ", args.treatment_file[1], "...")
         find_union_islands.main(args, temp_dir_1, temp_dir_2, pool)
         print("\n")
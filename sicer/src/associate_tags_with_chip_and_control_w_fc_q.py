@@ -14,6 +14,7 @@ import scipy
 import scipy.stats
 
 from sicer.lib import associate_tags_with_regions
+from sicer.lib import chrom_scheduler
 
 
 def associate_tag_count_to_regions(args, scaling_factor, control_library_size, genomesize, chrom):
@@ -57,7 +58,8 @@ def associate_tag_count_to_regions(args, scaling_factor, control_library_size, g
         if (control_count > 0):
             average = control_count * scaling_factor
         else:
-            length = island[2] - island[1] + 1
+            # Python integers, so that the product with the library size cannot overflow the type of the coordinates
+            length = int(island[2]) - int(island[1]) + 1
             average = length * control_library_size * 1.0 / genomesize
             average = min(0.25, average) * scaling_factor;
         fc = float(observation_count) / float(average)
@@ -98,7 +100,7 @@ def main(args, chip_library_size, control_library_size, pool):
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
     associate_tag_count_to_regions_partial = partial(associate_tag_count_to_regions, args, scaling_factor,
                                                      control_library_size, genomesize)
-    p_value_files = pool.map(associate_tag_count_to_regions_partial, chroms)
+    p_value_files = chrom_scheduler.chrom_map(pool, associate_tag_count_to_regions_partial, chroms, args)
     #pool.close()
 
     # Get the list of p-value from each parallel processes and concatenate them into one list of all p-values
@@ -8,6 +8,8 @@ from math import *
 
 import numpy as np
 
+from sicer.lib import window_store
+
 
 '''version 8: 3-phase coarse graining, take the phase that has most 1 to next step. '''
 
@@ -245,19 +247,14 @@ def traceback(List, win_min, step, level, genome_length, chrom):
 	return islandlist
 
 def filter_and_find_islands(args, min_tag_count, chrom):
-	graph_file = args.treatment_file.replace('.bed', '') + '_' + chrom + '_graph.npy'
-	chrom_windows = np.load(graph_file, allow_pickle=True)
+	graph_file = window_store.graph_file_name(args.treatment_file.replace('.bed', ''), chrom)
+	chrom_windows = window_store.load_windows(graph_file)
 	print_return = ''
 	total_count_island = 0
+	np_islands = np.array([], dtype=object)
 	if (len(chrom_windows) > 0):
 		chrom_lengths = args.species_chrom_lengths[chrom]
-		eligible_start_list = []
-
-		for i in range(0, len(chrom_windows)):
-			window = chrom_windows[i]
-			read_count = window[3]
-			if read_count >= min_tag_count:
-				eligible_start_list.append(window[1])
+		eligible_start_list = chrom_windows['start'][chrom_windows['count'] >= min_tag_count].tolist()
 		island_list = coarsegraining(eligible_start_list, args.window_size, args.step_size, args.step_score,
 									 chrom_lengths)
 		islands = traceback(island_list, args.window_size, args.step_size, 0, chrom_lengths, chrom)
@@ -269,8 +266,8 @@ def filter_and_find_islands(args, min_tag_count, chrom):
 			islands[i] = (island[0], int(island[1]), int(island[2]))
 
 		np_islands = np.array(islands, dtype=object)
-		np.save(graph_file, np_islands)
 		total_count_island = len(islands)
+	np.save(graph_file, np_islands)
 
 	return (total_count_island, print_return)
 
@@ -14,6 +14,7 @@ import scipy.stats
 
 from sicer.lib import Utility
 from sicer.lib import associate_tags_with_regions
+from sicer.lib import chrom_scheduler
 
 
 def calc_pvalue(chip_read_count, control_read_count, scaling_factor, pseudo_count):
@@ -120,7 +121,7 @@ def main(args, path_to_tempdir_1, path_to_tempdir_2, A_library_size, B_library_s
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
     associate_tag_count_to_regions_partial = partial(associate_tags_count_to_regions, args, path_to_tempdir_1,
                                                      path_to_tempdir_2, library_scaling_factor)
-    tag_counts = pool.map(associate_tag_count_to_regions_partial, chroms)
+    tag_counts = chrom_scheduler.chrom_map(pool, associate_tag_count_to_regions_partial, chroms, args)
     #pool.close()
 
     total_read_count_A = 0  # Count of all the reads of library A that belong in islands
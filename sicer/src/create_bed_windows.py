@@ -4,6 +4,8 @@ from functools import partial
 import subprocess
 import sys
 
+from sicer.lib import chrom_scheduler
+
 def create_bed_windows(chrom, chrom_length, bin_size):
     file_save_name = chrom + '.windows'
     syntax = 'echo "%s\\t%s" > %s.temp; bedtools makewindows -g %s.temp -w %s > %s ; rm -rf %s.temp' % (chrom, chrom_length, chrom, chrom, bin_size, file_save_name, chrom)
@@ -27,4 +29,4 @@ def main(args, pool):
         list_of_args.append((chrom, chrom_length, args.bin_size))
 
     create_bed_windows_partial = partial(create_bed_windows)
-    pool.starmap(create_bed_windows_partial, list_of_args)
+    chrom_scheduler.chrom_map(pool, create_bed_windows_partial, list_of_args, args, star=True)
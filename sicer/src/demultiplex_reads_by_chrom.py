@@ -0,0 +1,321 @@
+# Reads a BED, tagAlign (both optionally gzip compressed) or BAM library once and routes
+# every read into a per-chromosome buffer on disk.
+# Replaces grepping the whole input file once for every chromosome.
+# Chromosomes cut into shards (see sicer.lib.chrom_scheduler) get one buffer per
+# shard, so that the worker of a shard reads only the reads of its own range.
+# BAM files with a .bai index and BED files with an up to date sidecar index (see
+# sicer.lib.bed_index) are not demultiplexed: every worker reads its own chromosome
+# or shard straight from the input file instead. When a cache directory is given,
+# the sidecar index of a plain BED file is written there while it is demultiplexed.
+# Large plain-text files are split into byte ranges that begin at line boundaries.
+# The ranges are parsed in parallel by the worker processes of the pool, each writing
+# its own per-chromosome fragments, which are then joined in file order.
+# A library given as '-' is read from standard input; its format is guessed from
+# its first bytes (see sicer.lib.stream_reader).
+
+import os
+import shutil
+import sys
+from functools import partial
+
+import numpy as np
+
+from sicer.lib import bam_reader
+from sicer.lib import bed_index
+from sicer.lib import bed_parser
+from sicer.lib import chrom_scheduler
+from sicer.lib import gzip_reader
+from sicer.lib import stream_reader
+
+# Name under which a library is given to read it from standard input
+STDIN = '-'
+
+
+def buffer_file_name(file_name, chrom, shard=None):
+    if shard is not None:
+        file_name = chrom_scheduler.shard_file_name(file_name, shard)
+    return file_name + '_' + chrom + '.reads'
+
+
+def fragment_file_name(file_name, chrom, shard, part):
+    return buffer_file_name(file_name, chrom, shard) + '.' + str(part)
+
+
+def chrom_buffers(chroms, chrom_cuts):
+    '''Returns the (chrom, shard) pairs of the buffers of the chromosomes, where shard is None for the chromosomes
+        that are not cut into shards'''
+    buffers = []
+    for chrom, cuts in zip(chroms, chrom_cuts):
+        if cuts:
+            buffers.extend((chrom, shard) for shard in range(len(cuts) + 1))
+        else:
+            buffers.append((chrom, None))
+    return buffers
+
+
+# Plain-text files are only parsed in parallel if every byte range holds at least this many bytes
+MIN_RANGE_SIZE = 1 << 26
+
+
+def is_stdin(path_to_file):
+    return path_to_file == STDIN
+
+
+def is_bam(path_to_file):
+    return path_to_file.lower().endswith('.bam')
+
+
+def is_gzip(path_to_file):
+    return path_to_file.lower().endswith('.gz')
+
+
+def library_file_name(path_to_file, paired_end=False):
+    '''Returns the name under which the library in path_to_file is processed. Libraries are named as their
+        uncompressed BED conversion would be: x.bed.gz and x.tagAlign.gz become x.bed, x.bedpe becomes x.pe.bed and
+        x.bam becomes x.bed, or x.pe.bed for paired-end reads. A library read from standard input is named stdin.bed.'''
+    if is_stdin(path_to_file):
+        return 'stdin.pe.bed' if paired_end else 'stdin.bed'
+    file_name = os.path.basename(path_to_file)
+    if is_gzip(file_name):
+        file_name = file_name[:-len('.gz')]
+    if file_name.lower().endswith('.tagalign'):
+        file_name = file_name[:-len('.tagAlign')] + '.bed'
+    if bed_parser.is_bedpe(file_name):
+        file_name = file_name[:-len('.bedpe')] + '.pe.bed'
+    if is_bam(file_name):
+        file_name = file_name[:-len('.bam')] + ('.pe.bed' if paired_end else '.bed')
+    return file_name
+
+
+def is_plain_text(path_to_file):
+    '''Returns True if path_to_file is an uncompressed text file, which can be indexed and read in parallel'''
+    return not is_stdin(path_to_file) and not is_bam(path_to_file) and not is_gzip(path_to_file)
+
+
+def read_stream_blocks(infile, chroms, paired_end=False, with_names=False):
+    '''Yields (chrom_index, reads) for consecutive blocks of the library read from the binary stream infile,
+        which may hold BAM, gzip compressed or plain BED text.'''
+    reader = stream_reader.PeekableReader(infile)
+    stream_format = stream_reader.sniff_format(reader)
+    if stream_format == 'bam':
+        for block in bam_reader.read_bam_stream_blocks(reader, reader.name, chroms, paired_end, with_names):
+            yield block
+        return
+    if stream_format == 'gzip':
+        chunks = gzip_reader.prefetch(gzip_reader.stream_chunks(reader))
+    else:
+        chunks = gzip_reader.prefetch(iter(lambda: reader.read(1 << 24), b''))
+    for block in bed_parser.line_blocks(chunks):
+        yield bed_parser.parse_bed_block(block, chroms, reader.name, with_names=with_names)
+
+
+def read_library_blocks(path_to_file, chroms, paired_end=False, with_names=False, num_threads=1, index_builder=None):
+    '''Yields (chrom_index, reads) for consecutive blocks of the BED, tagAlign, BEDPE or BAM file path_to_file.
+        The names and scores of the reads are kept if with_names is True.
+        Compressed BED and tagAlign files are decompressed with up to num_threads threads.
+        The blocks of a plain-text file are also added to index_builder, if given.'''
+    if is_stdin(path_to_file):
+        for block in read_stream_blocks(sys.stdin.buffer, chroms, paired_end, with_names):
+            yield block
+    elif is_bam(path_to_file):
+        for block in bam_reader.read_bam_blocks(path_to_file, chroms, paired_end, with_names):
+            yield block
+    elif is_gzip(path_to_file):
+        for block in bed_parser.line_blocks(gzip_reader.read_chunks(path_to_file, num_threads)):
+            yield bed_parser.parse_block(block, chroms, path_to_file, with_names=with_names)
+    else:
+        with open(path_to_file, 'rb') as infile:
+            block_offset = 0
+            for block in bed_parser.read_blocks(infile):
+                chrom_index, reads, line_starts, line_ends = bed_parser.parse_block(block, chroms, path_to_file, True, with_names)
+                if index_builder is not None:
+                    index_builder.add_block(block_offset, chrom_index, reads, line_starts, line_ends)
+                block_offset += len(block)
+                yield (chrom_index, reads)
+
+
+def append_reads(output_file, reads):
+    with open(output_file, 'ab') as outfile:
+        reads.tofile(outfile)
+
+
+def append_by_chrom(chrom_index, reads, chroms, chrom_cuts, output_file_name, read_counts):
+    '''Appends the reads of a block to output_file_name(chrom, shard) for each of their chromosomes, where the
+        reads of a chromosome cut into shards at chrom_cuts are split by shard and shard is None otherwise'''
+    order = np.argsort(chrom_index, kind='stable')
+    present, first = np.unique(chrom_index[order], return_index=True)
+    for i, chrom_reads in zip(present, np.split(reads[order], first[1:])):
+        chrom = chroms[i]
+        read_counts[chrom] += len(chrom_reads)
+        cuts = chrom_cuts[i]
+        if not cuts:
+            append_reads(output_file_name(chrom, None), chrom_reads)
+            continue
+        shards = chrom_scheduler.shard_of(chrom_reads['start'], cuts)
+        shard_order = np.argsort(shards, kind='stable')
+        present_shards, shard_first = np.unique(shards[shard_order], return_index=True)
+        for shard, shard_reads in zip(present_shards, np.split(chrom_reads[shard_order], shard_first[1:])):
+            append_reads(output_file_name(chrom, int(shard)), shard_reads)
+
+
+def demultiplex(path_to_file, file_name, chroms, chrom_cuts, paired_end=False, with_names=False, num_threads=1,
+                cache_dir=None):
+    '''Reads path_to_file once and appends each read of a chromosome in chroms to <file_name>_<chrom>.reads, or to
+        the buffer of its shard for the chromosomes cut into shards at chrom_cuts.
+        Reads on any other chromosome are skipped. Returns a dictionary of the number of reads found per chromosome.
+        The sidecar index of a plain-text file is written to cache_dir, if given.'''
+    read_counts = dict.fromkeys(chroms, 0)
+    for chrom, shard in chrom_buffers(chroms, chrom_cuts):
+        open(buffer_file_name(file_name, chrom, shard), 'wb').close()
+
+    index_builder = None
+    if cache_dir is not None and is_plain_text(path_to_file):
+        index_builder = bed_index.ChromIndexBuilder(path_to_file, chroms)
+    for chrom_index, reads in read_library_blocks(path_to_file, chroms, paired_end, with_names, num_threads, index_builder):
+        append_by_chrom(chrom_index, reads, chroms, chrom_cuts, partial(buffer_file_name, file_name), read_counts)
+
+    if index_builder is not None:
+        index_builder.write(cache_dir)
+    return read_counts
+
+
+def split_ranges(path_to_file, num_ranges):
+    '''Splits the file path_to_file into at most num_ranges byte ranges of similar size.
+        Every range begins at the start of a line.'''
+    size = os.path.getsize(path_to_file)
+    boundaries = [0]
+    with open(path_to_file, 'rb') as infile:
+        for k in range(1, num_ranges):
+            offset = size * k // num_ranges
+            if offset <= boundaries[-1]:
+                continue
+            # Moves to the start of the first line beginning at or after offset
+            infile.seek(offset - 1)
+            infile.readline()
+            boundary = infile.tell()
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def demultiplex_range(path_to_file, file_name, chroms, chrom_cuts, with_names, byte_range):
+    '''Parses the byte range (part, begin, end) of the plain-text file path_to_file and appends each read of a
+        chromosome in chroms to the fragment <file_name>_<chrom>.reads.<part> of its buffer.
+        Returns the read counts and the index builder of the range, or None if the range could not be parsed.'''
+    part, begin, end = byte_range
+    read_counts = dict.fromkeys(chroms, 0)
+    index_builder = bed_index.ChromIndexBuilder(path_to_file, chroms)
+    try:
+        with open(path_to_file, 'rb') as infile:
+            block_offset = begin
+            for block in bed_index.range_blocks(infile, begin, end):
+                chrom_index, reads, line_starts, line_ends = bed_parser.parse_block(block, chroms, path_to_file, True, with_names)
+                index_builder.add_block(block_offset, chrom_index, reads, line_starts, line_ends)
+                block_offset += len(block)
+                append_by_chrom(chrom_index, reads, chroms, chrom_cuts, partial(fragment_file_name, file_name, part=part),
+                                read_counts)
+    except SystemExit:
+        # The error has been reported already; an exiting pool worker would leave the parent waiting forever
+        return None
+    return (read_counts, index_builder)
+
+
+def join_fragments(file_name, num_parts, chrom, shard):
+    '''Joins the fragments of a chromosome or shard written by demultiplex_range into its buffer, in file order'''
+    chrom_buffer = buffer_file_name(file_name, chrom, shard)
+    fragments = [fragment_file_name(file_name, chrom, shard, part) for part in range(num_parts)]
+    fragments = [fragment for fragment in fragments if os.path.exists(fragment)]
+    if not fragments:
+        open(chrom_buffer, 'wb').close()
+        return
+    os.replace(fragments[0], chrom_buffer)
+    with open(chrom_buffer, 'ab') as outfile:
+        for fragment in fragments[1:]:
+            with open(fragment, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, 1 << 24)
+            os.remove(fragment)
+
+
+def parallel_demultiplex(path_to_file, file_name, chroms, chrom_cuts, num_ranges, pool, with_names=False,
+                         cache_dir=None):
+    '''Same as demultiplex for the plain-text file path_to_file, which is split into num_ranges byte ranges
+        parsed in parallel by the processes of pool.'''
+    byte_ranges = [(part, begin, end) for part, (begin, end) in enumerate(split_ranges(path_to_file, num_ranges))]
+    results = pool.map(partial(demultiplex_range, path_to_file, file_name, chroms, chrom_cuts, with_names), byte_ranges)
+    pool.starmap(partial(join_fragments, file_name, len(byte_ranges)), chrom_buffers(chroms, chrom_cuts))
+    if any(result is None for result in results):
+        sys.exit(1)
+
+    read_counts = dict.fromkeys(chroms, 0)
+    index_builder = results[0][1]
+    for part_counts, part_builder in results:
+        for chrom in chroms:
+            read_counts[chrom] += part_counts[chrom]
+        if part_builder is not index_builder:
+            index_builder.merge(part_builder)
+    if cache_dir is not None:
+        index_builder.write(cache_dir)
+    return read_counts
+
+
+def chrom_read_blocks(path_to_file, chrom, paired_end=False, with_names=False, cache_dir=None, cuts=(), shard=0,
+                      block_size=1 << 20):
+    '''Yields the reads of one chromosome of the library path_to_file in blocks, in the order of the input file.
+        If the chromosome is cut into shards at cuts, only the reads of the given shard are yielded.
+        The reads come from the buffer stored by demultiplex (block_size reads at a time, or all of them if
+        block_size is -1), or from the index of libraries that were not demultiplexed, found in cache_dir for
+        BED files.'''
+    file_name = library_file_name(path_to_file, paired_end).replace('.bed', '')
+    chrom_buffer = buffer_file_name(file_name, chrom, shard if cuts else None)
+    begin, end = chrom_scheduler.shard_range(cuts, shard)
+    if os.path.exists(chrom_buffer):
+        with open(chrom_buffer, 'rb') as infile:
+            while True:
+                reads = np.fromfile(infile, dtype=bed_parser.get_read_dtype(with_names), count=block_size)
+                if len(reads) == 0:
+                    break
+                yield reads
+    elif is_bam(path_to_file):
+        for reads in bam_reader.read_bam_chrom_blocks(path_to_file, bam_reader.index_file_name(path_to_file), chrom,
+                                                      paired_end, with_names, begin, end):
+            yield reads
+    else:
+        index = bed_index.load_index(path_to_file, [chrom], cache_dir)
+        for reads in bed_index.read_chrom_blocks(path_to_file, index, chrom, with_names, begin, end):
+            yield reads
+
+
+def remove_chrom_buffer(path_to_file, chrom, paired_end=False, shard=None):
+    chrom_buffer = buffer_file_name(library_file_name(path_to_file, paired_end).replace('.bed', ''), chrom, shard)
+    if os.path.exists(chrom_buffer):
+        os.remove(chrom_buffer)
+
+
+def main(args, path_to_file, paired_end=False, pool=None, with_names=False):
+    '''path_to_file: complete path to the .bed, .tagAlign (optionally gzip compressed) or .bam file that needs to be
+        separated by chromosome, or '-' to read the library from standard input.
+        paired_end: if True, the reads of a BAM file are paired into fragments.
+        pool: if given, large plain-text files are parsed in parallel by its processes.
+        with_names: if True, the names and scores of the reads are kept.
+        The buffers are named after library_file_name without the .bed extension; the chromosomes cut into shards by
+        chrom_scheduler.chrom_shards get one buffer per shard.
+        Indexed BAM files are left to chrom_read_blocks and None is returned. For BED files with an up to date
+        sidecar index in args.cache_dir, the read counts are taken from the index.'''
+    chroms = args.species_chroms
+    chrom_cuts = chrom_scheduler.chrom_shards(args)
+    if is_bam(path_to_file) and bam_reader.index_file_name(path_to_file) is not None:
+        return None
+    if args.cache_dir is not None and is_plain_text(path_to_file):
+        index = bed_index.load_index(path_to_file, chroms, args.cache_dir)
+        if bed_index.is_seekable(index, chroms, chrom_cuts):
+            print("Using the chromosome index", bed_index.index_file_name(path_to_file, args.cache_dir), "of",
+                  os.path.basename(path_to_file))
+            return {chrom: index[chrom]['reads'] for chrom in chroms}
+    file_name = library_file_name(path_to_file, paired_end).replace('.bed', '')
+    if pool is not None and is_plain_text(path_to_file):
+        num_ranges = min(args.cpu, os.path.getsize(path_to_file) // MIN_RANGE_SIZE)
+        if num_ranges > 1:
+            return parallel_demultiplex(path_to_file, file_name, chroms, chrom_cuts, num_ranges, pool, with_names,
+                                        args.cache_dir)
+    return demultiplex(path_to_file, file_name, chroms, chrom_cuts, paired_end, with_names, args.cpu, args.cache_dir)
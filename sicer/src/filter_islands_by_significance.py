@@ -9,6 +9,8 @@ from math import *
 
 import numpy as np
 
+from sicer.lib import chrom_scheduler
+
 
 def filter_by_fdr_SICER(args, chrom):
     file_name = args.treatment_file.replace('.bed', '') + '_' + chrom + '_island_summary.npy'
@@ -53,10 +55,10 @@ def main(args, columnindex, pool):
     filtered_output = []
     if (df_call):
         filter_by_fdr_partial = partial(filter_by_fdr_SICER_df, args, columnindex)
-        filtered_output = pool.map(filter_by_fdr_partial, chroms)
+        filtered_output = chrom_scheduler.chrom_map(pool, filter_by_fdr_partial, chroms, args)
     else:
         filter_by_fdr_partial = partial(filter_by_fdr_SICER, args)
-        filtered_output = pool.map(filter_by_fdr_partial, chroms)
+        filtered_output = chrom_scheduler.chrom_map(pool, filter_by_fdr_partial, chroms, args)
 
     outfile_name = ''
     if (df_call and args.subcommand == "SICER"):
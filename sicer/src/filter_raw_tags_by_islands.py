@@ -12,19 +12,22 @@ from math import *
 
 import numpy as np
 
+from sicer.lib import bed_parser
+from sicer.lib import chrom_scheduler
+
 
 def tag_position(read, fragment_size):
     shift = int(round(fragment_size / 2))
-    if (read[5] == '+'):
-        return read[1] + shift
-    elif (read[5] == '-'):
-        return read[2] - 1 - shift
+    if (read['strand'] == bed_parser.PLUS):
+        return read['start'] + shift
+    elif (read['strand'] == bed_parser.MINUS):
+        return read['end'] - 1 - shift
 
 
 def filter_tags_by_islands(file_name, fragment_size, chrom):
     island_list = np.load(file_name + '_' + chrom + '_island_summary.npy', allow_pickle=True)
     read_list = np.load(file_name + '_' + chrom + '.npy', allow_pickle=True)
-    filtered_reads = []
+    keep = np.zeros(len(read_list), dtype=bool)
     if (len(island_list) > 0):
         island_start_list = []
         island_end_list = []
@@ -35,13 +38,12 @@ def filter_tags_by_islands(file_name, fragment_size, chrom):
         island_start_list.sort()
         island_end_list.sort()
 
-        for read in read_list:
+        for i, read in enumerate(read_list):
             position = tag_position(read, fragment_size)
             if bisect.bisect_right(island_start_list, position) - bisect.bisect_left(island_end_list, position) == 1:
-                filtered_reads.append(read)
+                keep[i] = True
 
-    np_filtered_reads = np.array(filtered_reads, dtype=object)
-    np.save(file_name + '_' + chrom + '_filtered.npy', np_filtered_reads)
+    np.save(file_name + '_' + chrom + '_filtered.npy', read_list[keep])
 
 
 def main(args, pool):
@@ -51,7 +53,7 @@ def main(args, pool):
     # Use multiprocessing to filter raw tags by islands in parallel processes
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
     filter_tags_by_islands_partial = partial(filter_tags_by_islands, treatment_file, args.fragment_size)
-    pool.map(filter_tags_by_islands_partial, chroms)
+    chrom_scheduler.chrom_map(pool, filter_tags_by_islands_partial, chroms, args)
     #pool.close()
 
     output_file_name = treatment_file + '-W' + str(args.window_size)
@@ -63,7 +65,5 @@ def main(args, pool):
         for chrom in chroms:
             filtered_bed = np.load(treatment_file + '_' + chrom + '_filtered.npy', allow_pickle=True)
             for read in filtered_bed:
-                output_line = str(read[0]) + '\t' + str(read[1]) + '\t' + str(read[2]) + '\t' + str(
-                    read[3]) + '\t' + str(read[4]) + '\t' + str(read[5]) + '\n'
-                outfile.write(output_line)
+                outfile.write(bed_parser.bed_line(chrom, read))
 
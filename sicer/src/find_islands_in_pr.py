@@ -12,6 +12,8 @@ from math import *
 import numpy as np
 
 from sicer.lib import Background_island_probscore_statistics
+from sicer.lib import chrom_scheduler
+from sicer.lib import window_store
 
 """
 Take in coords for bed_gaph type summary files and find 'islands' of modifications.
@@ -36,119 +38,145 @@ score < islands_minimum_tags
 """
 
 
-# Factorial
-def fact(m):
-    value = 1.0
-    if m != 0:
-        while m != 1:
-            value = value * m
-            m = m - 1
-    return value
-
-
-# Return the log of a factorial, using Srinivasa Ramanujan's approximation when m>=20
-def factln(m):
-    if m < 20:
-        value = 1.0
-        if m != 0:
-            while m != 1:
-                value = value * m
-                m = m - 1
-        return log(value)
-    else:
-        return m * log(m) - m + log(m * (1 + 4 * m * (1 + 2 * m))) / 6.0 + log(pi) / 2
+# Windows at most gap + WINDOW_SIZE_BUFFER bp away from the end of the previous eligible window are in the same island
+WINDOW_SIZE_BUFFER = 2
 
+# Score tables built by this process, by (size, average), so that every pool worker builds a table once
+score_tables = {}
 
-def poisson(i, average):
-    if i < 20:
-        return exp(-average) * average ** i / fact(i)
-    else:
-        exponent = -average + i * log(average) - factln(i)
-        return exp(exponent)
+
+def get_score_table(size, average):
+    '''Returns the Poisson score table of the counts 0 to size - 1, built once per process'''
+    key = (size, average)
+    if key not in score_tables:
+        score_tables[key] = Background_island_probscore_statistics.poisson_score_table(size, average)
+    return score_tables[key]
 
 
 def combine_proximal_islands(islands, gap, window_size_buffer=3):
     """
-    islands: a list of tuples of following format: (chrom, start, end, score)
+    islands: an object array with one row (chrom, start, end, score) per window, sorted by start.
     Therefore, "islands[index][1]" would mean the start position of the window at the given index
     Extend the regions found in the find_continuous_region function.
     If gap is not allowed, gap = 0, if one window is allowed, gap = window_size (200)
 
-    Return a list of combined regions.
+    Return an object array of the combined regions, in the same format. The scores of the windows of a region
+    are added up in order, as Python numbers.
     """
 
     proximal_island_dist = gap + window_size_buffer
 
     if len(islands) == 0:
-        return []
-    final_islands = []
-    current_island = islands[0]
-
-    if len(islands) == 1:
-        final_islands = islands
-    else:
-        for index in range(1, len(islands)):
-            dist = islands[index][1] - current_island[2]
-            if dist <= proximal_island_dist:
-                current_island[2] = islands[index][2]
-                current_island[3] += islands[index][3]
-            else:
-                final_islands.append(current_island)
-                current_island = islands[index]
-        # The last island:
-        final_islands.append(current_island)
-
+        return np.array([], dtype=object)
+    starts = islands[:, 1].astype(np.int64)
+    ends = islands[:, 2].astype(np.int64)
+    # A region ends wherever the next window starts further than proximal_island_dist from its end
+    first = np.concatenate(([0], np.flatnonzero(starts[1:] - ends[:-1] > proximal_island_dist) + 1))
+    last = np.append(first[1:], len(islands)) - 1
+
+    final_islands = np.empty((len(first), 4), dtype=object)
+    final_islands[:, 0] = islands[first, 0]
+    final_islands[:, 1] = islands[first, 1]
+    final_islands[:, 2] = islands[last, 2]
+    final_islands[:, 3] = np.add.reduceat(islands[:, 3], first)
     return final_islands
 
 
 def find_region_above_threshold(island_list, score_threshold):
-    filtered_islands = []
-    for island in island_list:
-        if island[3] >= (score_threshold - .0000000001):
-            filtered_islands.append(island)
-    return filtered_islands
-
-
-def filter_ineligible_windows(chrom_graph, min_tags_in_window, average):
-    '''Filters windows that have tag count lower than the minimum threshold count and calculates score for windows that meet the minimum count.
-        Score is defined as s = -log(Poisson(read_count,lambda))'''
-
-    filtered_chrom_graph = []
-    for window in chrom_graph:
-        read_count = window[3]
-        score = -1
-        if (read_count >= min_tags_in_window):
-            prob = poisson(read_count, average)
-            if prob < 1e-250:
-                score = 1000  # outside of the scale, take an arbitrary number.
-            else:
-                score = -log(prob)
-        eligible_window = (window[0], window[1], window[2], score)
-        if score > 0:
-            filtered_chrom_graph.append(eligible_window)
-
-    np_filtered_chrom_graph = np.array(filtered_chrom_graph, dtype=object)
-    return np_filtered_chrom_graph
-
-
-def filter_and_find_islands(min_tags_in_window, gap_size, score_threshold, average, verbose, graph_file):
-    '''Function for handling multiprocessing. Calls functions for filtering windows and finding islands.'''
-    number_of_islands = 0
+    if len(island_list) == 0:
+        return island_list
+    return island_list[island_list[:, 3].astype(np.float64) >= (score_threshold - .0000000001)]
+
+
+def extend_score_table(score_table, read_counts, average):
+    '''Returns score_table, or a larger table if it does not reach the largest of read_counts'''
+    max_count = int(read_counts.max()) if len(read_counts) > 0 else 0
+    if max_count >= len(score_table):
+        score_table = Background_island_probscore_statistics.poisson_score_table(max_count + 1, average)
+    return score_table
+
+
+def eligible_windows(chrom_graph, min_tags_in_window, average, score_table):
+    '''Returns the indices of the windows that have at least min_tags_in_window tags and a positive score, and the
+        score table, extended if it does not reach the largest count.
+        Score is defined as s = -log(Poisson(read_count,lambda)), looked up by read count in score_table'''
+    read_counts = chrom_graph['count'].astype(np.int64)
+    score_table = extend_score_table(score_table, read_counts, average)
+    eligible = np.flatnonzero(read_counts >= min_tags_in_window)
+    eligible = eligible[score_table[read_counts[eligible]].astype(np.float64) > 0]
+    return (eligible, score_table)
+
+
+def window_rows(chrom, chrom_graph, windows, score_table):
+    '''Returns an object array with one row (chrom, start, end, score) per window of chrom_graph indexed in windows'''
+    if len(windows) == 0:
+        return np.array([], dtype=object)
+    rows = np.empty((len(windows), 4), dtype=object)
+    rows[:, 0] = chrom
+    rows[:, 1] = chrom_graph['start'][windows].tolist()
+    rows[:, 2] = chrom_graph['end'][windows].tolist()
+    rows[:, 3] = score_table[chrom_graph['count'][windows].astype(np.int64)]
+    return rows
+
+
+def shard_windows(chrom_graph, min_tags_in_window, gap_size, average, score_table, cuts):
+    '''Returns, for every shard of a chromosome with boundaries cuts, the eligible windows of chrom_graph that make up
+        the islands beginning in the shard. No island spans more than gap_size + WINDOW_SIZE_BUFFER bp without an
+        eligible window, so the eligible windows are cut into independent islands wherever they are further apart,
+        and every island goes to the shard in which its first window starts.'''
+    eligible = eligible_windows(chrom_graph, min_tags_in_window, average, score_table)[0]
+    starts = chrom_graph['start'][eligible].astype(np.int64)
+    ends = chrom_graph['end'][eligible].astype(np.int64)
+    begins = np.ones(len(eligible), dtype=bool)
+    begins[1:] = starts[1:] - ends[:-1] > gap_size + WINDOW_SIZE_BUFFER
+    island_ids = np.cumsum(begins) - 1
+    window_shards = chrom_scheduler.shard_of(starts[begins], cuts)[island_ids]
+    # The windows are sorted by start, so that the windows of every shard follow each other
+    bounds = np.searchsorted(window_shards, np.arange(len(cuts) + 2))
+    return [chrom_graph[eligible[bounds[shard]:bounds[shard + 1]]] for shard in range(len(cuts) + 1)]
+
+
+def find_islands(chrom, chrom_graph, windows, gap_size, score_threshold, score_table):
+    '''Returns the islands made of the windows of chrom_graph indexed in windows'''
+    islands = combine_proximal_islands(window_rows(chrom, chrom_graph, windows, score_table), gap_size,
+                                       WINDOW_SIZE_BUFFER)
+    return find_region_above_threshold(islands, score_threshold)
+
+
+def island_result(verbose, graph_file, num_windows, chrom, islands):
+    '''Saves the islands in place of the num_windows windows in the graph file of the chromosome'''
     print_return = ""
-    chrom_graph = np.load(graph_file, allow_pickle=True)
-
-    if (len(chrom_graph) > 0):
-        chrom = chrom_graph[0][0]
-        filtered_chrom_graph = filter_ineligible_windows(chrom_graph, min_tags_in_window, average)
-        islands = combine_proximal_islands(filtered_chrom_graph, gap_size, 2)
-        islands = find_region_above_threshold(islands, score_threshold)
-        number_of_islands += len(islands)
-        if not (len(islands) > 0):
-            if verbose:
-                print_return += chrom + " does not have any islands meeting the required significance"
-        np.save(graph_file, islands)
-
-    return (graph_file, number_of_islands, print_return)
+    if num_windows > 0 and not (len(islands) > 0):
+        if verbose:
+            print_return += chrom + " does not have any islands meeting the required significance"
+    np.save(graph_file, islands)
+    return (graph_file, len(islands), print_return)
+
+
+def filter_and_find_islands(min_tags_in_window, gap_size, score_threshold, average, table_size, verbose, file, chrom,
+                            shard_graph=None):
+    '''Function for handling multiprocessing. Calls functions for filtering windows and finding islands.
+        The islands replace the windows in the graph file of the chromosome. For one shard of a chromosome cut
+        into shards, shard_graph holds the eligible windows of the shard found by shard_windows, and only the
+        islands of the shard are returned, which join_island_shards saves.'''
+    score_table = get_score_table(table_size, average)
+    if shard_graph is not None:
+        score_table = extend_score_table(score_table, shard_graph['count'], average)
+        return find_islands(chrom, shard_graph, np.arange(len(shard_graph)), gap_size, score_threshold, score_table)
+    graph_file = window_store.graph_file_name(file, chrom)
+    chrom_graph = window_store.load_windows(graph_file)
+    eligible, score_table = eligible_windows(chrom_graph, min_tags_in_window, average, score_table)
+    islands = find_islands(chrom, chrom_graph, eligible, gap_size, score_threshold, score_table)
+    return island_result(verbose, graph_file, len(chrom_graph), chrom, islands)
+
+
+def join_island_shards(verbose, file, chrom, num_windows, shard_results):
+    '''Saves the islands found in the shards of a chromosome of num_windows windows, in order, and returns the same
+        as filter_and_find_islands'''
+    graph_file = window_store.graph_file_name(file, chrom)
+    islands = [shard_islands for shard_islands in shard_results if len(shard_islands) > 0]
+    islands = np.concatenate(islands) if islands else np.array([], dtype=object)
+    return island_result(verbose, graph_file, num_windows, chrom, islands)
 
 
 def main(args, total_read_count, pool):
@@ -192,17 +220,40 @@ def main(args, total_read_count, pool):
     # filter the summary graph to get rid of windows whose scores are less than window_score_threshold
 
     file = args.treatment_file.replace('.bed', '')
-    list_of_graph_files = []
-    for chrom in chroms:
-        list_of_graph_files.append(file + '_' + chrom + '_graph.npy')
 
     # Use multiprocessing to filter windows with tag count below minimum requirement
     print(
         "Generating the enriched probscore summary graph and filtering the summary graph to eliminate ineligible windows... ")
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
     filter_and_find_islands_partial = partial(filter_and_find_islands, min_tags_in_window, args.gap_size,
-                                              score_threshold, average, args.verbose)
-    filtered_islands_result = pool.map(filter_and_find_islands_partial, list_of_graph_files)
+                                              score_threshold, average, background.max_index, args.verbose, file)
+    # Long chromosomes are cut into shards. Their eligible windows are split between the shards here, once, and
+    # their islands are gathered once all shards are done.
+    score_table = get_score_table(background.max_index, average)
+    chrom_cuts = chrom_scheduler.chrom_shards(args)
+    tasks = []
+    weights = []
+    num_windows = {}
+    for chrom, chrom_length, cuts in zip(chroms, chrom_scheduler.chrom_weights(args), chrom_cuts):
+        if not cuts:
+            tasks.append((chrom,))
+            weights.append(chrom_length)
+            continue
+        chrom_graph = window_store.load_windows(window_store.graph_file_name(file, chrom))
+        num_windows[chrom] = len(chrom_graph)
+        shard_graphs = shard_windows(chrom_graph, min_tags_in_window, args.gap_size, average, score_table, cuts)
+        tasks.extend((chrom, shard_graph) for shard_graph in shard_graphs)
+        weights.extend(chrom_scheduler.shard_lengths(chrom_length, cuts))
+    results = iter(chrom_scheduler.weighted_map(pool, filter_and_find_islands_partial, tasks, weights, args.cpu,
+                                                star=True))
+    filtered_islands_result = []
+    for chrom, cuts in zip(chroms, chrom_cuts):
+        if not cuts:
+            filtered_islands_result.append(next(results))
+        else:
+            shard_results = [next(results) for shard in range(len(cuts) + 1)]
+            filtered_islands_result.append(join_island_shards(args.verbose, file, chrom, num_windows[chrom],
+                                                              shard_results))
     #pool.close()
 
     file_name = args.treatment_file.replace('.bed', '')
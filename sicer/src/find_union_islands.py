@@ -10,6 +10,8 @@ from math import *
 
 import numpy as np
 
+from sicer.lib import chrom_scheduler
+
 # Function designed for handling multiprocessing. Executes the redundancy removal algorithm
 # for each independent chromosome
 def find_union_islands(no_control, temp_dir_1, temp_dir_2, chrom):
@@ -63,7 +65,7 @@ def main(args, temp_dir_1, temp_dir_2, pool):
     # Use multiprocessing module to run parallel processes for each chromosome
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
     find_union_islands_partial = partial(find_union_islands, no_control, temp_dir_1, temp_dir_2)
-    pool.map(find_union_islands_partial, chroms)
+    chrom_scheduler.chrom_map(pool, find_union_islands_partial, chroms, args)
     #pool.close()
 
     outfile_name = (args.treatment_file[0].replace('.bed', '') + '-vs-' + args.treatment_file[1].replace('.bed', '') + '-W' + str(
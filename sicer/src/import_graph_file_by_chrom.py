@@ -7,6 +7,9 @@ import subprocess
 import sys
 import numpy as np
 
+from sicer.lib import chrom_scheduler
+from sicer.lib import window_store
+
 def match_chrom(file, chrom):
     match = chrom + "[[:space:]]"
     matched_reads = subprocess.Popen(['grep', match, file], stdout=subprocess.PIPE) #Use Popen so that if no matches are found, it doesn't throw an exception
@@ -41,10 +44,11 @@ def separate_reads(path_to_file, chrom):
     (chrom_reads, chrom_graph, tag_count) = match_chrom(path_to_file, chrom)  # Separates all reads by chromosome
 
     file_save_name = file_name + '_' + chrom + '.npy'
-    graph_save_name = file_name + '_' + chrom + '_graph.npy'
+    graph_save_name = window_store.graph_file_name(file_name, chrom)
 
-    np_chrom_graph = np.array(chrom_graph, dtype=object)
-    np.save(graph_save_name, np_chrom_graph)
+    window_store.save_windows(graph_save_name, window_store.make_windows([window[1] for window in chrom_graph],
+                                                                         [window[2] for window in chrom_graph],
+                                                                         [window[3] for window in chrom_graph]))
 
     np_chrom_reads = np.array(chrom_reads, dtype=object)
     np.save(file_save_name, np_chrom_reads)
@@ -56,7 +60,7 @@ def main(args, path_to_file, pool):
     chroms = args.species_chroms
 
     separate_reads_partial = partial(separate_reads, path_to_file)
-    tag_counts = pool.map(separate_reads_partial, chroms)
+    tag_counts = chrom_scheduler.chrom_map(pool, separate_reads_partial, chroms, args)
 
     total_tag_count = 0
     for result in tag_counts:
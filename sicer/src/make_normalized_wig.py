@@ -7,12 +7,11 @@ from math import *
 
 import numpy as np
 
+from sicer.lib import chrom_scheduler
+from sicer.lib import window_store
+
 def get_counts(graph_file):
-    chrom_graph = np.load(graph_file, allow_pickle=True)
-    count = 0
-    for line in chrom_graph:
-        count += line[3]
-    return count
+    return window_store.total_count(graph_file)
 
 
 def main(args, output_file_name, pool):
@@ -24,14 +23,11 @@ def main(args, output_file_name, pool):
     filtered_mode = "islandfiltered" in output_file_name
     list_of_graph_files = []
     for chrom in chroms:
-        if filtered_mode:
-            list_of_graph_files.append(file + '_' + chrom + '_filtered_graph.npy')
-        else:
-            list_of_graph_files.append(file + '_' + chrom + '_graph.npy')
+        list_of_graph_files.append(window_store.graph_file_name(file, chrom, filtered_mode))
 
     # Use multiprocessing to count the number of islands
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
-    count_results = pool.map(get_counts, list_of_graph_files)
+    count_results = chrom_scheduler.chrom_map(pool, get_counts, list_of_graph_files, args)
     #pool.close()
     for count in count_results:
         total_count += count
@@ -45,10 +41,8 @@ def main(args, output_file_name, pool):
             file = file + '-islandfiltered'
         outfile.write("track type=wiggle_0 name=" + file + "\n")
         for i in range(0, len(chroms)):
-            chrom_graph = np.load(list_of_graph_files[i], allow_pickle=True)
+            chrom_graph = window_store.load_windows(list_of_graph_files[i], mmap=True)
             if (len(chrom_graph) > 0):
                 outfile.write("variableStep chrom=" + chroms[i] + " span=" + str(args.window_size) + "\n")
-                for window in chrom_graph:
-                    normalized_tag_count = round(float(window[3] / scaling_factor), 2)
-                    start_coord = window[1] + 1
-                    outfile.write(str(start_coord) + "\t" + str(normalized_tag_count) + "\n")
+                outfile.writelines([str(start + 1) + "\t" + str(round(count / scaling_factor, 2)) + "\n" for start, count
+                                    in zip(chrom_graph['start'].tolist(), chrom_graph['count'].tolist())])
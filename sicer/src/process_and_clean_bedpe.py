@@ -1,75 +1,78 @@
 # Written: 2022 STJUDE Modupeore Adetunji
 
 from functools import partial
+import os
 import subprocess
-import re
+import sys
 import numpy as np
 
+from sicer.lib import bed_parser
+from sicer.lib import chrom_scheduler
+from sicer.lib import window_store
+
+def split_intersect_output(output, num_fields):
+    '''Returns (buf, field_starts, field_ends) for the first num_fields fields of the lines of bedtools output'''
+    buf = np.frombuffer(output + b'\n', dtype=np.uint8)
+    line_starts, line_ends = bed_parser.split_lines(buf)
+    field_starts, field_ends, fields_per_line = bed_parser.split_fields(buf, line_starts, line_ends, num_fields)
+    return (buf, field_starts, field_ends)
+
 def graph_bins_chrom(file, chrom):
     file_name = file.replace('.bed', '')
     bed_file_name = file_name + '_' + chrom + '.npy'
     new_file_name = file_name + '_' + chrom + '-results.bed'
 
     print_return = ""
-    chrom_reads = np.load(bed_file_name, allow_pickle=True)
+    bed_reads = np.load(bed_file_name, allow_pickle=True)
     with open(new_file_name, 'w') as outfile:
-        for read in chrom_reads:
-            chrom = read[0]
-            start = read[1]
-            end = read[2]
-            name = read[3]
-            score = read[4]
-            strand = read[5]
-            line = (chrom + '\t' + str(start) + '\t' + str(end) + '\t' + name + '\t' + str(score) + '\t' + strand + '\n')
-            outfile.write(line)
+        for read in bed_reads:
+            outfile.write(bed_parser.bed_line(chrom, read))
 
     windows = chrom + '.windows'
     graph_reads = subprocess.Popen(['bedtools', 'intersect', '-c', '-a', windows, '-b', new_file_name], stdout=subprocess.PIPE)
     data_reads = subprocess.Popen(['bedtools', 'intersect', '-c', '-b', windows, '-a', new_file_name], stdout=subprocess.PIPE)
-    chrom_reads = str(graph_reads.communicate()[0], 'utf-8').splitlines()
-    chrom_datas = str(data_reads.communicate()[0], 'utf-8').splitlines()
-
-    chrom_graph = []
-    chrom_data = []
-    tag_count = 0
-    for i, reads in enumerate(chrom_reads):
-        reads = re.split('\t', reads)
-        reads[1] = int(reads[1])
-        reads[2] = int(reads[2])
-        reads[3] = int(reads[3])
-        if reads[3] > 0:
-            output = (chrom, reads[1], reads[2], reads[3])
-            chrom_graph.append(output)
-            tag_count += reads[3]
-
-    for i, reads in enumerate(chrom_datas):
-        reads = re.split('\t', reads)
-        reads[1] = int(reads[1])
-        reads[2] = int(reads[2])
-        reads[6] = int(reads[6])
-        if reads[6] > 0:
-            output = (chrom, reads[1], reads[2], reads[3], reads[4], reads[5], reads[6])
-            chrom_data.append(output)
+    (buf, field_starts, field_ends) = split_intersect_output(graph_reads.communicate()[0], 4)
+    (read_buf, read_field_starts, read_field_ends) = split_intersect_output(data_reads.communicate()[0], 7)
 
+    # Every window is reported with the number of reads overlapping it; only windows with reads are kept
+    graph_counts = bed_parser.int_field(buf, field_starts[3], field_ends[3], windows)
+    has_reads = graph_counts > 0
+    chrom_graph = window_store.make_windows(bed_parser.int_field(buf, field_starts[1], field_ends[1], windows)[has_reads],
+                                            bed_parser.int_field(buf, field_starts[2], field_ends[2], windows)[has_reads],
+                                            graph_counts[has_reads])
+    tag_count = int(graph_counts[has_reads].sum())
 
+    # The reads are reported in the order of the file, each followed by the number of windows it overlaps
+    window_counts = bed_parser.int_field(read_buf, read_field_starts[6], read_field_ends[6], new_file_name)
+    if len(window_counts) != len(bed_reads):
+        sys.stderr.write("Error: bedtools intersect reported " + str(len(window_counts)) + " of the "
+                         + str(len(bed_reads)) + " reads of " + os.path.basename(new_file_name) + "\n")
+        sys.exit(1)
+    chrom_data = bed_reads[window_counts > 0]
 
     file_save_name = file_name + '_' + chrom + '.npy'
-    graph_save_name = file_name + '_' + chrom + '_graph.npy'
-
-    np_chrom_graph = np.array(chrom_graph, dtype=object)
-    np.save(graph_save_name, np_chrom_graph)
+    window_store.save_windows(window_store.graph_file_name(file_name, chrom), chrom_graph)
 
-    np_chrom_reads = np.array(chrom_data, dtype=object)
-    np.save(file_save_name, np_chrom_reads)
+    np.save(file_save_name, chrom_data)
 
     print_return += ('Total count of ' + chrom + ' tags: ' + str(tag_count) + '\n')
     return (print_return, tag_count)
 
+def try_graph_bins_chrom(file, chrom):
+    '''Same as graph_bins_chrom, but returns None if the chromosome could not be processed'''
+    try:
+        return graph_bins_chrom(file, chrom)
+    except SystemExit:
+        # The error has been reported already; an exiting pool worker would leave the parent waiting forever
+        return None
+
 def main(args, file, pool):
     chroms = args.species_chroms
 
-    graph_bins_chrom_partial = partial(graph_bins_chrom, file)
-    tag_counts = pool.map(graph_bins_chrom_partial, chroms)
+    graph_bins_chrom_partial = partial(try_graph_bins_chrom, file)
+    tag_counts = chrom_scheduler.chrom_map(pool, graph_bins_chrom_partial, chroms, args)
+    if any(result is None for result in tag_counts):
+        sys.exit(1)
     total_tag_count = 0
     print_return = ""
     for result in tag_counts:
@@ -4,55 +4,140 @@
 
 import multiprocessing as mp
 import os
-import re
 import sys
-import subprocess
 from functools import partial
 import numpy as np
 
+from sicer.lib import bed_parser
+from sicer.lib import chrom_scheduler
+from sicer.src import demultiplex_reads_by_chrom
+
 '''Filters redundant reads according to the cutoff value by taking a sorted list and comparing adjacent reads'''
 
 
 def remove_redundant_1chrom_single_strand_sorted(reads, cutoff):
-    current_start = 0
-    current_end = 0
-    current_count = 1
-    total = 0
-    retained = 0
-    mask = []
-
-    for i, read in enumerate(reads):
-        total += 1
-        start = read[1]
-        end = read[2]
-        if start != current_start:
-            retained += 1
-            current_start = start
-            current_end = end
-            current_count = 1
-        elif end != current_end:
-            retained += 1
-            current_start = start
-            current_end = end
-            current_count = 1
-        else:
-            current_count += 1
-            if current_count <= cutoff:
-                retained += 1
-            else:
-                mask.append(i)
-
-    return (total, retained, mask)
+    '''Returns (total, retained, redundant), where redundant is a boolean array marking the reads beyond the
+        first cutoff copies of a run of identical (start, end) reads'''
+    total = len(reads)
+    if total == 0:
+        return (0, 0, np.zeros(0, dtype=bool))
+    starts = reads['start']
+    ends = reads['end']
+    new_run = np.empty(total, dtype=bool)
+    # The first read is compared with (0, 0), so a read at (0, 0) counts as the second copy of its run
+    new_run[0] = starts[0] != 0 or ends[0] != 0
+    np.logical_or(starts[1:] != starts[:-1], ends[1:] != ends[:-1], out=new_run[1:])
+    positions = np.arange(total)
+    run_starts = np.maximum.accumulate(np.where(new_run, positions, -1))
+    copy_number = positions - run_starts + 1
+    redundant = ~new_run & (copy_number > cutoff)
+    retained = total - int(np.count_nonzero(redundant))
+    return (total, retained, redundant)
+
+
+# Bit of the packed key set for minus strand reads. Start and end take 31 bits each below it.
+MINUS_KEY_BIT = np.uint64(1 << 62)
+# Marks a free slot of the hash table of first_copies. Never a packed key, whose bit 63 is always clear.
+EMPTY_SLOT = np.uint64(2**64 - 1)
+# Multiplier of the Fibonacci hashing of packed keys
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+# Sorting reads takes about this many times their size in memory
+SORT_MEMORY_FACTOR = 4
+# Smallest number of reads read from a sorted run at a time when merging runs
+MIN_MERGE_BLOCK_SIZE = 1 << 16
+
+
+def pack_keys(reads):
+    '''Packs the strand, start and end of every read into one uint64 key that orders reads like (strand, start, end).
+        Returns None if some read has a strand other than + and - or a negative coordinate.'''
+    strands = reads['strand']
+    is_minus = strands == bed_parser.MINUS
+    if not np.all(is_minus | (strands == bed_parser.PLUS)):
+        return None
+    if len(reads) > 0 and min(reads['start'].min(), reads['end'].min()) < 0:
+        return None
+    keys = reads['start'].astype(np.uint64) << np.uint64(31)
+    keys |= reads['end'].astype(np.uint64)
+    keys[is_minus] |= MINUS_KEY_BIT
+    return keys
+
+
+def sort_reads(reads):
+    '''Returns reads sorted like np.sort(reads, order=['strand', 'start', 'end']), which breaks ties by name and
+        score. Sorts packed integer keys instead of the structured array when possible, and does not sort reads
+        that are already in order.'''
+    keys = pack_keys(reads)
+    if keys is None:
+        return np.sort(reads, order=['strand', 'start', 'end'])
+    if np.all(keys[1:] >= keys[:-1]):
+        order = np.arange(len(reads))
+    else:
+        order = np.argsort(keys, kind='stable')
+    if 'name' in reads.dtype.names:
+        # Only runs of reads with equal keys need their names and scores compared
+        sorted_keys = keys[order]
+        tied = np.zeros(len(reads), dtype=bool)
+        same_as_next = sorted_keys[1:] == sorted_keys[:-1]
+        tied[1:] |= same_as_next
+        tied[:-1] |= same_as_next
+        positions = np.flatnonzero(tied)
+        if len(positions) > 0:
+            tied_order = order[positions]
+            tied_reads = reads[tied_order]
+            order[positions] = tied_order[np.lexsort((tied_reads['score'], tied_reads['name'], keys[tied_order]))]
+    return reads[order]
+
+
+def hash_slots(keys):
+    '''Returns the slot of every key in a hash table filled by vectorized linear probing, and the size of the table.
+        Equal keys always share a slot and different keys never do.'''
+    size = 1 << max(int(2 * len(keys) - 1).bit_length(), 1)
+    shift = np.uint64(64 - (size.bit_length() - 1))
+    table = np.full(size, EMPTY_SLOT, dtype=np.uint64)
+    probes = ((keys * HASH_MULTIPLIER) >> shift).astype(np.int64)
+    slots = np.empty(len(keys), dtype=np.int64)
+    pending = np.arange(len(keys))
+    while len(pending) > 0:
+        probe = probes[pending]
+        free = table[probe] == EMPTY_SLOT
+        # Of the keys probing the same free slot, one takes it and the others move on with the next probe
+        table[probe[free]] = keys[pending[free]]
+        found = table[probe] == keys[pending]
+        slots[pending[found]] = probe[found]
+        pending = pending[~found]
+        probes[pending] = (probes[pending] + 1) & (size - 1)
+    return (slots, size)
+
+
+def first_copies(keys, cutoff):
+    '''Returns a boolean array marking the first cutoff copies of every key, in input order, without sorting.
+        As in remove_redundant_1chrom_single_strand_sorted, the first copy is always kept and reads at (0, 0)
+        keep one copy less.'''
+    keep = np.zeros(len(keys), dtype=bool)
+    (slots, size) = hash_slots(keys)
+    remaining = np.arange(len(keys))
+    for copy in range(max(cutoff, 1)):
+        if len(remaining) == 0:
+            break
+        first = np.full(size, len(keys), dtype=np.int64)
+        np.minimum.at(first, slots[remaining], remaining)
+        is_first = first[slots[remaining]] == remaining
+        keep[remaining[is_first]] = True
+        remaining = remaining[~is_first]
+    for zero_key in (np.uint64(0), MINUS_KEY_BIT):
+        zero_reads = np.flatnonzero(keys == zero_key)
+        keep[zero_reads] = False
+        keep[zero_reads[:max(cutoff - 1, 0)]] = True
+    return keep
 
 
 '''Separates reads by positive and negative strands before filtering redudant reads.
     Saves the filtered reads as a numpy binary file in temporary directory created in run_SICER.
-    This is because python cannot pass extremely large objects between parallel processes'''
+    This is because python cannot pass extremely large objects between parallel processes.
+    Returns the read counts [total plus, retained plus, total minus, retained minus] and the number of retained reads'''
 
 
 def strand_broken_remove(chrom, cutoff, file, chrom_reads):
-    # Use of multiprocessing means print statements will be out of order. Use print_return to hold them until the end
-    print_return = ""
     #plus_reads = []
     #minus_reads = []
     #for read in chrom_reads:
@@ -68,89 +153,370 @@ def strand_broken_remove(chrom, cutoff, file, chrom_reads):
     #plus_reads = sorted(plus_reads, key=lambda x: (x[1], x[2]))
     #minus_reads = sorted(minus_reads, key=lambda x: (x[1], x[2]))
 
-    sorted_reads = np.sort(chrom_reads, order=['strand','start','end'])
-    mark = 0
-    for i in range(len(sorted_reads)):
-        if sorted_reads[i][5] != '+':
-            mark = i
-            break
-
-    (p_total, p_retained, p_mask) = remove_redundant_1chrom_single_strand_sorted(sorted_reads[:mark], cutoff)
-    (m_total, m_retained, m_mask) = remove_redundant_1chrom_single_strand_sorted(sorted_reads[mark:], cutoff)
-    m_mask = [m_mask[i]+mark for i in range(len(m_mask))]
-    mask = p_mask + m_mask
-    filtered_reads = np.delete(sorted_reads, obj=mask)
+    keys = pack_keys(chrom_reads)
+    if keys is not None and 'name' not in chrom_reads.dtype.names and np.any(keys[1:] < keys[:-1]):
+        # Without names, copies of a read are interchangeable and the order of the saved reads does not matter,
+        # so unsorted reads are counted in a hash table instead of being sorted
+        keep = first_copies(keys, cutoff)
+        is_minus = keys >= MINUS_KEY_BIT
+        (p_total, m_total) = (len(keys) - int(np.count_nonzero(is_minus)), int(np.count_nonzero(is_minus)))
+        m_retained = int(np.count_nonzero(keep & is_minus))
+        p_retained = int(np.count_nonzero(keep)) - m_retained
+        filtered_reads = chrom_reads[keep]
+    else:
+        sorted_reads = sort_reads(chrom_reads)
+        is_plus = sorted_reads['strand'] == bed_parser.PLUS
+        plus_reads = sorted_reads[is_plus]
+        minus_reads = sorted_reads[~is_plus]
+
+        (p_total, p_retained, p_redundant) = remove_redundant_1chrom_single_strand_sorted(plus_reads, cutoff)
+        (m_total, m_retained, m_redundant) = remove_redundant_1chrom_single_strand_sorted(minus_reads, cutoff)
+        filtered_reads = np.concatenate((plus_reads[~p_redundant], minus_reads[~m_redundant]))
     #print_return += (chrom + "\tPlus reads: " + str(p_total) + "\t\tRetained plus reads: " + str(
     #    p_retained) + "\tMinus reads: "
     #                 + str(m_total) + "\tRetained minus reads: " + str(m_retained))
 
-    print_return += ('{:<5s}{:^25d}{:^25d}{:^25d}{:^25d}'.format(chrom, p_total, p_retained, m_total, m_retained))
-
     #filtered_output = filtered_plus_reads + filtered_minus_reads
     #np_filtered_output = np.array(filtered_output, dtype=object)
     name_for_save = file + "_" + chrom + ".npy"
     np.save(name_for_save, filtered_reads)
     total_retained = p_retained + m_retained
 
-    return (print_return, total_retained)
-
-
-'''Opens the given file and greps all the reads of the given chromsome and stores them in a list of tuples
-    Tuple format: (chrom,start,end,name,score,strand)'''
-
-
-def match_by_chrom(file, chrom):
-    match = chrom + "[[:space:]]"
-    matched_reads = subprocess.Popen(['grep', match, file], stdout=subprocess.PIPE) #Use Popen so that if no matches are found, it doesn't throw an exception
-    chrom_reads = str(matched_reads.communicate()[0],'utf-8').splitlines()  # generates a list of each reads, which are represented by a string value
-    file_name = os.path.basename(file)
-    read_dtype = np.dtype([('chrom', 'U6'), ('start', np.int32), ('end', np.int32), ('name', 'U20'), ('score', np.int32), ('strand', 'U1')])
-    processed_reads = np.empty(len(chrom_reads), dtype=read_dtype)
-
-    for i, reads in enumerate(chrom_reads):
-        reads = re.split('\t', reads)
-        if (len(reads) < 6):
-            sys.stderr.write(
-                "Error: Input BED files must have the first six fields. Check " + file_name + " to see if it has the following fields: chrom, chromStart, chromEnd, name, score, and strand\n")
-            sys.exit(1)
-        reads[1] = int(reads[1])
-        reads[2] = int(reads[2])
-        processed_reads[i] = tuple(reads)
-
-    return processed_reads
-
-
-'''Function designed for handling multiprocessing. Separates all reads by chromosome
-    and then filters redudant reads'''
-
-
-def find_and_filter_reads(path_to_file, cutoff, chrom):
-    file_name = os.path.basename(path_to_file)
+    return ([p_total, p_retained, m_total, m_retained], total_retained)
+
+
+'''Streaming version of strand_broken_remove for reads sorted by start coordinate, as produced by most aligners.
+    read_blocks yields the reads of the chromosome in input order. They are regrouped into chunks that never split
+    a group of reads with the same start, and each chunk is sorted, filtered and appended to a spill file per strand.
+    Because the starts of consecutive chunks do not overlap, this gives the same result as sorting the whole
+    chromosome, while only one chunk is held in memory. Returns None as soon as the reads turn out not to be sorted
+    (or to hold strands other than + and -), in which case the caller falls back to strand_broken_remove.'''
+
+
+def stream_sorted_remove(chrom, cutoff, file, read_blocks, with_names=False):
+    spill_names = {'+': file + '_' + chrom + '_plus.spill', '-': file + '_' + chrom + '_minus.spill'}
+    counts = {'+': [0, 0], '-': [0, 0]}  # total and retained reads
+    last_read = {'+': None, '-': None}
+    spills = {strand: open(name, 'wb') for strand, name in spill_names.items()}
+
+    def filter_chunk(chunk):
+        sorted_chunk = sort_reads(chunk)
+        mark = np.searchsorted(sorted_chunk['strand'], bed_parser.MINUS)
+        for strand, strand_reads in (('+', sorted_chunk[:mark]), ('-', sorted_chunk[mark:])):
+            if len(strand_reads) == 0:
+                continue
+            # The last read of the previous chunk is filtered again so that the first read of this chunk is
+            # compared with it, as it would be in the whole chromosome. It is never written twice.
+            carried = last_read[strand] is not None
+            if carried:
+                strand_reads = np.concatenate((last_read[strand], strand_reads))
+            (total, retained, redundant) = remove_redundant_1chrom_single_strand_sorted(strand_reads, cutoff)
+            if carried:
+                total -= 1
+                if not redundant[0]:
+                    retained -= 1
+                redundant[0] = True
+            last_read[strand] = strand_reads[-1:]
+            strand_reads[~redundant].tofile(spills[strand])
+            counts[strand][0] += total
+            counts[strand][1] += retained
+
+    is_sorted = True
+    try:
+        pending = None
+        last_start = None
+        for reads in read_blocks:
+            if len(reads) == 0:
+                continue
+            starts = reads['start']
+            if (last_start is not None and starts[0] < last_start) or np.any(starts[1:] < starts[:-1]) \
+                    or not np.all((reads['strand'] == bed_parser.PLUS) | (reads['strand'] == bed_parser.MINUS)):
+                is_sorted = False
+                break
+            last_start = starts[-1]
+            if pending is not None:
+                reads = np.concatenate((pending, reads))
+            # Reads sharing the start of the last read may continue in the next block
+            cut = np.searchsorted(reads['start'], reads['start'][-1])
+            pending = reads[cut:]
+            filter_chunk(reads[:cut])
+        if is_sorted and pending is not None:
+            filter_chunk(pending)
+    finally:
+        read_blocks.close()
+        for spill in spills.values():
+            spill.close()
+    if not is_sorted:
+        for spill_name in spill_names.values():
+            os.remove(spill_name)
+        return None
+
+    (p_total, p_retained) = counts['+']
+    (m_total, m_retained) = counts['-']
+    name_for_save = file + "_" + chrom + ".npy"
+    total_retained = p_retained + m_retained
+    read_dtype = bed_parser.get_read_dtype(with_names)
+    if total_retained == 0:
+        np.save(name_for_save, np.empty(0, dtype=read_dtype))
+    else:
+        # The spill files are copied block by block into the .npy file, plus strand first
+        filtered_reads = np.lib.format.open_memmap(name_for_save, mode='w+', dtype=read_dtype, shape=(total_retained,))
+        position = 0
+        for strand in ('+', '-'):
+            with open(spill_names[strand], 'rb') as spill:
+                while True:
+                    block = np.fromfile(spill, dtype=read_dtype, count=1 << 20)
+                    if len(block) == 0:
+                        break
+                    filtered_reads[position:position + len(block)] = block
+                    position += len(block)
+        filtered_reads.flush()
+        del filtered_reads
+    for spill_name in spill_names.values():
+        os.remove(spill_name)
+
+    return ([p_total, p_retained, m_total, m_retained], total_retained)
+
+
+'''External sorting of the reads of chromosomes that do not fit in memory. The reads are cut into runs of at most
+    max_reads reads (plus one block), which are sorted by start and written to disk, and the runs are then merged
+    block by block into a single stream of reads sorted by start, which stream_sorted_remove filters.'''
+
+
+def write_sorted_run(chrom, file, blocks, run_number):
+    run = np.concatenate(blocks)
+    run_name = file + '_' + chrom + '_' + str(run_number) + '.run'
+    run[np.argsort(run['start'], kind='stable')].tofile(run_name)
+    return run_name
+
+
+def spill_sorted_runs(chrom, file, read_blocks, read_dtype, max_reads):
+    '''Collects the reads of read_blocks. Returns (reads, None) if there are at most max_reads of them, or
+        otherwise (None, run_names) with the names of the sorted runs written to disk.'''
+    blocks = []
+    num_reads = 0
+    run_names = []
+    try:
+        for reads in read_blocks:
+            blocks.append(reads)
+            num_reads += len(reads)
+            if num_reads > max_reads:
+                run_names.append(write_sorted_run(chrom, file, blocks, len(run_names)))
+                blocks = []
+                num_reads = 0
+    finally:
+        read_blocks.close()
+    if not run_names:
+        return (np.concatenate([np.empty(0, dtype=read_dtype)] + blocks), None)
+    if num_reads > 0:
+        run_names.append(write_sorted_run(chrom, file, blocks, len(run_names)))
+    return (None, run_names)
+
+
+def merge_sorted_runs(run_names, read_dtype, block_size):
+    '''Yields the reads of the runs in blocks sorted by start, reading block_size reads of a run at a time'''
+    runs = [open(run_name, 'rb') for run_name in run_names]
+    try:
+        buffers = [np.fromfile(run, dtype=read_dtype, count=block_size) for run in runs]
+        exhausted = [len(buffer) < block_size for buffer in buffers]
+        while any(len(buffer) > 0 for buffer in buffers):
+            # Reads starting before the last buffered start of every unfinished run precede all unread reads
+            last_starts = [buffer['start'][-1] for buffer, done in zip(buffers, exhausted) if not done and len(buffer) > 0]
+            bound = min(last_starts) if last_starts else None
+            parts = []
+            for i, buffer in enumerate(buffers):
+                cut = len(buffer) if bound is None else np.searchsorted(buffer['start'], bound)
+                parts.append(buffer[:cut])
+                buffers[i] = buffer[cut:]
+            merged = np.concatenate(parts)
+            if len(merged) > 0:
+                yield merged[np.argsort(merged['start'], kind='stable')]
+            # Runs holding the bound read on, so that it can be passed at the next round
+            for i, run in enumerate(runs):
+                if not exhausted[i] and len(buffers[i]) > 0 and buffers[i]['start'][-1] == bound:
+                    more = np.fromfile(run, dtype=read_dtype, count=block_size)
+                    exhausted[i] = len(more) < block_size
+                    buffers[i] = np.concatenate((buffers[i], more))
+    finally:
+        for run in runs:
+            run.close()
+
+
+'''Function designed for handling multiprocessing. Reads the reads of the chromosome separated by
+    demultiplex_reads_by_chrom and then filters redudant reads. Sorted reads are streamed through
+    stream_sorted_remove; other reads are loaded and sorted as a whole. The fragments of paired-end reads
+    are filtered in the same way, as reads spanning the whole fragment.'''
+
+
+def filter_read_blocks(chrom_read_blocks, chrom, cutoff, file_name, with_names, max_reads):
+    '''Filters the reads yielded by chrom_read_blocks(), which is called again if the reads turn out not to be
+        sorted, and saves them as <file_name>_<chrom>.npy. Returns the same as strand_broken_remove.'''
+    result = stream_sorted_remove(chrom, cutoff, file_name, chrom_read_blocks(), with_names)
+    if result is not None:
+        return result
+
+    read_dtype = bed_parser.get_read_dtype(with_names)
+    (chrom_reads, run_names) = spill_sorted_runs(chrom, file_name, chrom_read_blocks(), read_dtype, max_reads)
+    if run_names is None:
+        return strand_broken_remove(chrom, cutoff, file_name, chrom_reads)
+
+    try:
+        block_size = max(max_reads // (2 * len(run_names)), MIN_MERGE_BLOCK_SIZE)
+        result = stream_sorted_remove(chrom, cutoff, file_name, merge_sorted_runs(run_names, read_dtype, block_size), with_names)
+        if result is None:
+            # Reads with strands other than + and - are only handled in memory
+            chrom_reads = np.concatenate([np.fromfile(run_name, dtype=read_dtype) for run_name in run_names])
+            result = strand_broken_remove(chrom, cutoff, file_name, chrom_reads)
+    finally:
+        for run_name in run_names:
+            os.remove(run_name)
+    return result
+
+
+def redundancy_row(chrom, counts):
+    '''Returns the line of the redundancy table for the read counts of a chromosome'''
+    (p_total, p_retained, m_total, m_retained) = counts
+    # A chromosome without minus strand reads has always been reported with all of its reads as minus strand reads
+    if m_total == 0:
+        (p_total, p_retained, m_total, m_retained) = (0, 0, p_total, p_retained)
+    return '{:<5s}{:^25d}{:^25d}{:^25d}{:^25d}'.format(chrom, p_total, p_retained, m_total, m_retained)
+
+
+def find_and_filter_reads(path_to_file, cutoff, with_names, paired_end, max_reads, cache_dir, chrom):
+    file_name = demultiplex_reads_by_chrom.library_file_name(path_to_file, paired_end)
     file_name = file_name.replace('.bed', '')
 
-    chrom_reads = match_by_chrom(path_to_file, chrom)  # Separates all reads by chromosome
-    return strand_broken_remove(chrom, cutoff, file_name, chrom_reads)
+    read_blocks = partial(demultiplex_reads_by_chrom.chrom_read_blocks, path_to_file, chrom, paired_end, with_names,
+                          cache_dir)
+    (counts, total_retained) = filter_read_blocks(read_blocks, chrom, cutoff, file_name, with_names, max_reads)
+    demultiplex_reads_by_chrom.remove_chrom_buffer(path_to_file, chrom, paired_end)
+    return (redundancy_row(chrom, counts), total_retained)
+
+
+'''The reads of chromosomes cut into shards by chrom_scheduler are filtered one shard at a time. Copies of a read
+    share its start and therefore its shard, so the shards are filtered independently; every shard reads only its
+    own reads, from its own buffer or from its range of an indexed input. The reads of every shard are saved apart
+    and then joined in the order in which the whole chromosome would have been saved.'''
+
+
+def find_and_filter_shard(path_to_file, cutoff, with_names, paired_end, max_reads, cache_dir, chrom, shard, cuts):
+    '''Filters the reads of one shard of a chromosome. Returns the read counts and the number of retained reads
+        of the shard, or the result of find_and_filter_reads for a chromosome that is not cut into shards.'''
+    if not cuts:
+        return find_and_filter_reads(path_to_file, cutoff, with_names, paired_end, max_reads, cache_dir, chrom)
+    file_name = demultiplex_reads_by_chrom.library_file_name(path_to_file, paired_end).replace('.bed', '')
+    read_blocks = partial(demultiplex_reads_by_chrom.chrom_read_blocks, path_to_file, chrom, paired_end, with_names,
+                          cache_dir, cuts, shard)
+    result = filter_read_blocks(read_blocks, chrom, cutoff, chrom_scheduler.shard_file_name(file_name, shard),
+                                with_names, max_reads)
+    demultiplex_reads_by_chrom.remove_chrom_buffer(path_to_file, chrom, paired_end, shard)
+    return result
+
+
+def load_saved_reads(file_name):
+    '''Returns the reads saved in file_name, memory-mapped'''
+    try:
+        return np.load(file_name, mmap_mode='r')
+    except ValueError:
+        # Files without any read cannot be memory-mapped by older NumPy versions
+        return np.load(file_name)
+
+
+def layout_file_name(file_name, chrom):
+    return file_name + '_' + chrom + '_shards.npy'
+
+
+def join_shards(path_to_file, with_names, paired_end, chrom, shard_results):
+    '''Joins the reads saved for the shards of a chromosome into <file_name>_<chrom>.npy. Returns the same as
+        find_and_filter_reads. The rows (begin, end) of the reads of every shard within every strand are saved in
+        <file_name>_<chrom>_shards.npy, one row of shards per strand, for load_shard_reads.'''
+    if len(shard_results) == 1:
+        return shard_results[0]
+    file_name = demultiplex_reads_by_chrom.library_file_name(path_to_file, paired_end).replace('.bed', '')
+    shard_names = [chrom_scheduler.shard_file_name(file_name, shard) + '_' + chrom + '.npy'
+                   for shard in range(len(shard_results))]
+    shard_reads = [load_saved_reads(shard_name) for shard_name in shard_names]
+
+    # A whole chromosome is saved strand by strand, plus strand first, and sorted by start within each strand,
+    # unless it is kept in input order. The reads of each strand are therefore joined in shard order.
+    strands = sorted(set().union(*[np.unique(reads['strand']).tolist() for reads in shard_reads]),
+                     key=lambda strand: (strand != bed_parser.PLUS, strand))
+    total_retained = sum(result[1] for result in shard_results)
+    filtered_reads = np.lib.format.open_memmap(file_name + '_' + chrom + '.npy', mode='w+',
+                                               dtype=bed_parser.get_read_dtype(with_names), shape=(total_retained,))
+    layout = np.zeros((len(strands), len(shard_reads), 2), dtype=np.int64)
+    position = 0
+    for i, strand in enumerate(strands):
+        for shard, reads in enumerate(shard_reads):
+            strand_reads = reads[reads['strand'] == strand]
+            filtered_reads[position:position + len(strand_reads)] = strand_reads
+            layout[i, shard] = (position, position + len(strand_reads))
+            position += len(strand_reads)
+    filtered_reads.flush()
+    del filtered_reads
+    del shard_reads
+    np.save(layout_file_name(file_name, chrom), layout)
+    for shard_name in shard_names:
+        os.remove(shard_name)
+
+    counts = np.sum([result[0] for result in shard_results], axis=0).tolist()
+    return (redundancy_row(chrom, counts), total_retained)
+
+
+def load_shard_reads(file_name, chrom, shard):
+    '''Returns (reads, rows) for the reads of one shard of a chromosome joined by join_shards into
+        <file_name>_<chrom>.npy, where rows are their rows in that file, in order. Only the rows of the shard
+        are read.'''
+    layout = np.load(layout_file_name(file_name, chrom))
+    chrom_reads = load_saved_reads(file_name + '_' + chrom + '.npy')
+    slices = [(begin, end) for begin, end in layout[:, shard]]
+    reads = np.concatenate([chrom_reads[:0]] + [chrom_reads[begin:end] for begin, end in slices])
+    rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.arange(begin, end) for begin, end in slices])
+    return (reads, rows)
+
+
+def filter_reads_by_shard(args, path_to_file, cutoff, with_names, paired_end, pool):
+    '''Filters the reads of every chromosome of the library, shard by shard, and returns the results of
+        find_and_filter_reads for every chromosome'''
+    find_and_filter_shard_partial = partial(find_and_filter_shard, path_to_file, cutoff, with_names, paired_end,
+                                            max_chrom_reads(args, with_names), args.cache_dir)
+    shard_results = chrom_scheduler.shard_map(pool, find_and_filter_shard_partial, args)
+    join_shards_partial = partial(join_shards, path_to_file, with_names, paired_end)
+    return chrom_scheduler.chrom_map(pool, join_shards_partial, zip(args.species_chroms, shard_results), args, star=True)
+
+
+def max_chrom_reads(args, with_names=False):
+    '''Returns the number of reads a process sorts in memory within the --memory_per_cpu limit'''
+    return max(args.memory_per_cpu * (1 << 20) // (SORT_MEMORY_FACTOR * np.dtype(bed_parser.get_read_dtype(with_names)).itemsize), 1)
+
+
+def print_redundancy_table(filtered_result):
+    '''Prints the per-chromosome results of find_and_filter_reads and returns the total number of retained reads'''
+    total_read_count = 0
+    print(('-' *105))
+    print(('{:<5s}{:^25s}{:^25s}{:^25s}{:^25s}'.format("chrom", "Total plus reads", "Retained plus reads", "Total minus reads", "Retained minus reads")))
+    print(('-' *105))
+    for result in filtered_result:
+        print(result[0])
+        total_read_count += result[1]
+
+    return total_read_count
 
 
-'''path_to_file: complete path to the .bed file that needs to processed for redudant reads'''
+'''path_to_file: complete path to the .bed or .bam file that needs to processed for redudant reads
+    with_names: if True, the names and scores of the reads are kept for the --significant_reads output'''
 
 
-def main(args, path_to_file, pool):
+def main(args, path_to_file, pool, with_names=False):
     chroms = args.species_chroms;  # list of chromsomes of the given species
     cutoff = args.redundancy_threshold
 
+    # Separate all reads by chromosome in a single pass over the file
+    demultiplex_reads_by_chrom.main(args, path_to_file, pool=pool, with_names=with_names)
+
     # Use multiprocessing module to run parallel processes for each chromosome
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
-    find_and_filter_reads_partial = partial(find_and_filter_reads, path_to_file, cutoff)
-    filtered_result = pool.map(find_and_filter_reads_partial, chroms)
+    filtered_result = filter_reads_by_shard(args, path_to_file, cutoff, with_names, False, pool)
     #pool.close()
 
-    total_read_count = 0
-    print(('-' *105))
-    print(('{:<5s}{:^25s}{:^25s}{:^25s}{:^25s}'.format("chrom", "Total plus reads", "Retained plus reads", "Total minus reads", "Retained minus reads")))
-    print(('-' *105))
-    for result in filtered_result:
-        print(result[0])
-        total_read_count += result[1]
-
-    return total_read_count
+    return print_redundancy_table(filtered_result)
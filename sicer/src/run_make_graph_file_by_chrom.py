@@ -3,12 +3,33 @@
 # Modified by: Jin Yong Yoo
 
 import multiprocessing as mp
+import os
+import shutil
 from functools import partial
 from math import *
 import sys
 import numpy as np
 
-def get_bed_coords(chrom_reads, chrom_length, fragment_size, chrom, verbose):
+from sicer.lib import bed_parser
+from sicer.lib import chrom_scheduler
+from sicer.lib import tag_index
+from sicer.lib import window_store
+from sicer.src import remove_redundant_reads
+
+def illegitimate_reads(chrom_reads, chrom_length):
+    '''Reads with start less than zero or end beyond the chromosome length are illegitimate and ignored.
+        Returns the masks of the reads rejected for their start and for their end.'''
+    start_rejected = chrom_reads['start'] < 0
+    return (start_rejected, ~start_rejected & (chrom_reads['end'] >= chrom_length))
+
+
+def write_rejected_reads(reject_file, chrom, rejected_reads):
+    with open(reject_file, 'w') as outfile:
+        for read in rejected_reads:
+            outfile.write(bed_parser.bed_line(chrom, read))
+
+
+def get_bed_coords(chrom_reads, chrom_length, fragment_size, chrom, reject_file=None):
     """
     *This takes into account the identical tags
     *Tags on different strands are positioned differently
@@ -17,144 +38,219 @@ def get_bed_coords(chrom_reads, chrom_length, fragment_size, chrom, verbose):
     The stored positions are not the midpoint rather than the start
     The interface is no longer the same as that for getBedCoords(file)
     input:
-        file:  the file that has the raw tag data from one chromosome
+        chrom_reads: the array of the reads from one chromosome
         fragment_size: the fragment size after CHIP experiment.
+        reject_file: if given, the illegitimate reads, which are ignored, are written to this file in BED format
     output:
-        return: a sorted list of positions which might have redundent entries
+        return: an array of the positions of the tags, which might have redundent entries, and the tag
+            statistics [positive tags, negative tags, reads with start less than zero, reads with end beyond
+            the chromosome length]
     """
 
-    postive_tag_counts = 0
-    negative_tag_counts = 0
     shift = int(round(fragment_size / 2))
-    taglist = []
-    print_return = ""
-    for read in chrom_reads:
-        chrom = read[0]
-        start = read[1]
-        end = read[2]
-        name = read[3]
-        score = read[4]
-        strand = read[5]
-        if (start < 0):
-            if verbose:
-                print_return += ("Ilegitimate read with start less than zero is ignored \n"
-                                 + chrom + "\t" + str(start) + "\t" + str(
-                            end) + "\t" + name + "\t" + str(score) + "\t" + strand + "\n")
-        elif (end >= chrom_length):
-            if verbose:
-                print_return += (
-                            "Ilegitimate read with end beyond chromosome length " + str(chrom_length) + " is ignored \n"
-                            + chrom + "\t" + str(start) + "\t" + str(
-                        end) + "\t" + name + "\t" + str(score) + "\t" + strand + "\n")
-        else:
-            if (strand == '+'):
-                position = start + shift
-                # If the position is beyond limit then don't shift.
-                if (position >= chrom_length):
-                    position = chrom_length - 1
-                taglist.append(position)
-                postive_tag_counts += 1
-
-            elif (strand == '-'):
-                position = end - 1 - shift
-                # in case the shift move the positions
-                # beyond zero, use zero
-                if (position < 0):
-                    position = 0  # UCSC genome coordinate is 0-based
-                taglist.append(position)
-                negative_tag_counts += 1
-    taglist.sort()
+    start = chrom_reads['start'].astype(np.int64)
+    end = chrom_reads['end'].astype(np.int64)
+    strand = chrom_reads['strand']
+
+    start_rejected, end_rejected = illegitimate_reads(chrom_reads, chrom_length)
+    valid = ~(start_rejected | end_rejected)
+    plus = valid & (strand == bed_parser.PLUS)
+    minus = valid & (strand == bed_parser.MINUS)
+
+    # If the position is beyond limit then don't shift.
+    plus_positions = np.minimum(start[plus] + shift, chrom_length - 1)
+    # in case the shift move the positions beyond zero, use zero (UCSC genome coordinate is 0-based)
+    minus_positions = np.maximum(end[minus] - 1 - shift, 0)
+    taglist = np.concatenate((plus_positions, minus_positions))
+
+    num_start_rejected = int(np.count_nonzero(start_rejected))
+    num_end_rejected = int(np.count_nonzero(end_rejected))
+    if reject_file is not None:
+        write_rejected_reads(reject_file, chrom, chrom_reads[start_rejected | end_rejected])
+
+    return (taglist, [int(np.count_nonzero(plus)), int(np.count_nonzero(minus)), num_start_rejected, num_end_rejected])
+
 
+def tag_summary(chrom, chrom_length, verbose, stats):
+    '''Returns the messages to print for the tag statistics [positive tags, negative tags, reads with start less
+        than zero, reads with end beyond the chromosome length] of a chromosome'''
+    postive_tag_counts, negative_tag_counts, num_start_rejected, num_end_rejected = stats
     total_tag_counts = postive_tag_counts + negative_tag_counts
+    print_return = ""
+    if verbose and num_start_rejected + num_end_rejected > 0:
+        print_return += ("Ilegitimate reads ignored: " + str(num_start_rejected) + " with start less than zero, "
+                         + str(num_end_rejected) + " with end beyond chromosome length " + str(chrom_length) + "\n")
     print_return += 'Total count of ' + chrom + ' tags: ' + str(total_tag_counts)
     if verbose:
         print_return += ('  ('+str(postive_tag_counts) + ' positive tags, ' + str(negative_tag_counts) + ' negative tags)')
-
-    return (taglist, print_return)
+    return print_return
 
 
 def Generate_windows_and_count_tags(taglist, chrom, chrom_length, window_size):
     """
-    taglist: sorted list of positions that includes every tag on a chromosome
+    taglist: array of the positions of every tag on a chromosome, in any order
     window_size: the artificial bin size for binning the tags
-    bed_vals: a dictionary keyed by the start of tag_containing
-        windows, with value being the tag count in the window.
+    chrom_graph: the window records (start, end, count) of the
+        tag-containing windows, as stored by window_store.
 
     In this function, the bins are set up using an absolute coordinate
     system.  Namely [0, window_size-1),[window_size,
     2*window_size-1). If the last window goes beyond the limit of the chromosome,
     that window is ignored.
 
-    The result writen into the file is guaranteed to be already sorted
-    within a chromosome.
+    The windows are counted with np.bincount over the window index of every
+    tag, so the result is sorted within a chromosome.
     """
-    chrom_graph = []
-    total_tag_count = 0
+    window_counts = np.bincount(np.asarray(taglist, dtype=np.int64) // window_size)
+    return windows_from_counts(window_counts, chrom_length, window_size)
 
-    if (len(taglist) > 0):
-        current_window_start = (taglist[0] // window_size) * window_size
-        tag_count_in_current_window = 1
 
-        for i in range(1, len(taglist)):
-            start = (taglist[i] // window_size) * window_size
+def windows_from_counts(window_counts, chrom_length, window_size):
+    '''Returns (chrom_graph, tag_count) for the tag-containing windows of window_size, given the tag count of
+        every window of the chromosome from its start'''
+    window_index = np.flatnonzero(window_counts)
+    window_starts = window_index * window_size
+    window_ends = window_starts + window_size - 1
+    # if the window goes beyond the chromsome limit, it is discarded.
+    inside = window_ends < chrom_length
+    counts = window_counts[window_index[inside]]
 
-            if start == current_window_start:
-                tag_count_in_current_window += 1
+    chrom_graph = window_store.make_windows(window_starts[inside], window_ends[inside], counts)
+    return (chrom_graph, int(counts.sum()))
 
-            elif start > current_window_start:
-                # All the tags in the previous window have been counted
-                current_window_end = current_window_start + window_size - 1
-                # if the window goes beyond the chromsome limit, it is discarded.
 
-                if current_window_end < chrom_length:
-                    # write the window to file
-                    output = (chrom, current_window_start, current_window_end, tag_count_in_current_window)
-                    chrom_graph.append(output)
-                    total_tag_count += tag_count_in_current_window
+def windows_from_index(cumulative, chrom_length, window_size):
+    '''Returns (chrom_graph, tag_count) for the tag-containing windows of window_size, taken from the cumulative
+        counts of a tag index'''
+    window_starts, counts = tag_index.window_counts(cumulative, chrom_length, window_size)
+    has_tags = counts > 0
+    window_starts = window_starts[has_tags]
+    counts = counts[has_tags]
+    chrom_graph = window_store.make_windows(window_starts, window_starts + window_size - 1, counts)
+    return (chrom_graph, int(counts.sum()))
 
-                current_window_start = start
-                tag_count_in_current_window = 1
 
-            else:
-                sys.stderr.write("Error!")
-                sys.exit(1)
+def treatment_index_file(args, filtered, chrom):
+    '''Returns the name of the tag index of a chromosome of the treatment library in the cache directory, or None
+        if no index is kept. The tag index is kept in the cache directory, if any, and its window counts are
+        reused by later runs with any window size that is a multiple of the index resolution.'''
+    if args.cache_dir is None or filtered:
+        return None
+    return tag_index.index_file_name(args.cache_dir, args.treatment_path, args.fragment_size,
+                                     args.redundancy_threshold, chrom)
 
-        current_window_end = current_window_start + window_size - 1
-        # if the window goes beyond the chromsome limit, it is discarded.
-        if current_window_end < chrom_length:
-            output = (chrom, current_window_start, current_window_end, tag_count_in_current_window)
-            chrom_graph.append(output)
-            total_tag_count += tag_count_in_current_window
 
-    return (chrom_graph, total_tag_count)
+def can_use_index(args):
+    # The illegitimate reads to write out are only found in the reads themselves
+    return not args.rejected_reads and args.window_size % tag_index.INDEX_RESOLUTION == 0
 
 
 def makeGraphFile(args, filtered, chrom, chrom_length):
     file = args.treatment_file.replace('.bed', '')  # removes the .bed extension
 
-    bed_file_name = file + '_' + chrom   # name of the ChIP-seq reads
-    if filtered:
-        bed_file_name = bed_file_name + '_filtered.npy'
-    else:
-        bed_file_name = bed_file_name + '.npy'
-
-    chrom_reads = np.load(bed_file_name, allow_pickle=True)
+    index_file = treatment_index_file(args, filtered, chrom)
+    index = None
+    if index_file is not None:
+        index = tag_index.load_index(index_file, args.treatment_path, chrom_length)
 
-    tag_list, print_return = get_bed_coords(chrom_reads, chrom_length, args.fragment_size, chrom, args.verbose)
-    
-    chrom_graph, tag_count = Generate_windows_and_count_tags(tag_list, chrom, chrom_length, args.window_size)
-
-
-    file_save_name = file + '_' + chrom
-    if filtered:
-        file_save_name += '_filtered_graph.npy'
+    if index is not None and can_use_index(args):
+        cumulative, stats = index
+        chrom_graph, tag_count = windows_from_index(cumulative, chrom_length, args.window_size)
+        index_status = 'used'
     else:
-        file_save_name += '_graph.npy'
-    
-    #graph_dtype = np.dtype([('chrom', 'U6'), ('start', np.int32), ('end', np.int32), ('count', np.int32)])
-    np_chrom_graph = np.array(chrom_graph, dtype=object)
-    np.save(file_save_name, np_chrom_graph)
-    return (tag_count, print_return)
+        bed_file_name = file + '_' + chrom   # name of the ChIP-seq reads
+        if filtered:
+            bed_file_name = bed_file_name + '_filtered.npy'
+        else:
+            bed_file_name = bed_file_name + '.npy'
+
+        chrom_reads = np.load(bed_file_name, allow_pickle=True)
+
+        reject_file = None
+        if args.rejected_reads and not filtered:
+            reject_file = file + '_' + chrom + '_rejected.bed'
+        tag_list, stats = get_bed_coords(chrom_reads, chrom_length, args.fragment_size, chrom, reject_file)
+
+        chrom_graph, tag_count = Generate_windows_and_count_tags(tag_list, chrom, chrom_length, args.window_size)
+        index_status = None
+        if index_file is not None and index is None:
+            counts = tag_index.merge_bins([tag_index.bin_counts(tag_list)], chrom_length)
+            written = tag_index.save_index(index_file, args.treatment_path, counts, chrom_length, stats)
+            index_status = 'written' if written else 'failed'
+    window_store.save_windows(window_store.graph_file_name(file, chrom, filtered), chrom_graph)
+    return (tag_count, tag_summary(chrom, chrom_length, args.verbose, stats), stats[2] + stats[3], index_status)
+
+
+'''The chromosomes cut into shards by chrom_scheduler when their redundant reads were removed are counted shard by
+    shard. Every shard reads only its own rows of the reads of the chromosome and bins its tags; tags shifted across
+    a shard boundary are counted in the windows they fall in, and the bin counts of the shards are added up.'''
+
+
+def count_shard(args, chrom, shard, cuts):
+    '''Returns, for one shard of a chromosome, the window bin counts of its tags, the bin counts for the tag index
+        (None if no index is written), the tag statistics and the rows of the illegitimate reads. Returns None for
+        the shards of a chromosome counted whole by join_graph_shards.'''
+    if not cuts:
+        return None
+    file = args.treatment_file.replace('.bed', '')
+    layout_file = remove_redundant_reads.layout_file_name(file, chrom)
+    if not os.path.exists(layout_file) or np.load(layout_file).shape[1] != len(cuts) + 1:
+        return None
+    chrom_length = args.species_chrom_lengths[chrom]
+    index_file = treatment_index_file(args, False, chrom)
+    valid_index = index_file is not None and tag_index.is_valid_index(index_file, args.treatment_path, chrom_length)
+    if valid_index and can_use_index(args):
+        return None
+
+    reads, rows = remove_redundant_reads.load_shard_reads(file, chrom, shard)
+    tag_list, stats = get_bed_coords(reads, chrom_length, args.fragment_size, chrom)
+    rejected_rows = None
+    if args.rejected_reads:
+        start_rejected, end_rejected = illegitimate_reads(reads, chrom_length)
+        rejected_rows = rows[start_rejected | end_rejected]
+    index_bins = None
+    if index_file is not None and not valid_index:
+        index_bins = tag_index.bin_counts(tag_list)
+    return (tag_index.bin_counts(tag_list, args.window_size), index_bins, stats, rejected_rows)
+
+
+def join_graph_shards(args, chrom, chrom_length, shard_results):
+    '''Saves the graph file of a chromosome from the results of count_shard for its shards, and the tag index and
+        the illegitimate reads if needed. Returns the same as makeGraphFile.'''
+    if any(result is None for result in shard_results):
+        return makeGraphFile(args, False, chrom, chrom_length)
+    file = args.treatment_file.replace('.bed', '')
+    window_counts = tag_index.merge_bins([result[0] for result in shard_results], chrom_length, args.window_size)
+    chrom_graph, tag_count = windows_from_counts(window_counts, chrom_length, args.window_size)
+    window_store.save_windows(window_store.graph_file_name(file, chrom, False), chrom_graph)
+    stats = np.sum([result[2] for result in shard_results], axis=0).tolist()
+
+    index_status = None
+    if shard_results[0][1] is not None:
+        counts = tag_index.merge_bins([result[1] for result in shard_results], chrom_length)
+        written = tag_index.save_index(treatment_index_file(args, False, chrom), args.treatment_path, counts,
+                                       chrom_length, stats)
+        index_status = 'written' if written else 'failed'
+    if args.rejected_reads:
+        # Written in the order of the reads of the chromosome, as makeGraphFile does
+        rejected_rows = np.sort(np.concatenate([result[3] for result in shard_results]))
+        chrom_reads = remove_redundant_reads.load_saved_reads(file + '_' + chrom + '.npy')
+        write_rejected_reads(file + '_' + chrom + '_rejected.bed', chrom, chrom_reads[rejected_rows])
+    return (tag_count, tag_summary(chrom, chrom_length, args.verbose, stats), stats[2] + stats[3], index_status)
+
+
+def print_index_status(args, index_statuses):
+    '''Reports the chromosomes whose window counts were taken from the tag index in the cache directory, and the
+        chromosomes whose tag index was written there'''
+    library = os.path.basename(args.treatment_path)
+    num_used = index_statuses.count('used')
+    num_written = index_statuses.count('written')
+    if num_used > 0:
+        print("Window counts of", num_used, "chromosomes taken from the tag index of", library, "in", args.cache_dir)
+    if num_written > 0:
+        print("Wrote the tag index of", num_written, "chromosomes of", library, "to", args.cache_dir)
+    if 'failed' in index_statuses:
+        sys.stderr.write("Warning: The tag index of " + library + " cannot be written to " + args.cache_dir + "\n")
 
 
 def main(args, pool, filtered=False):
@@ -171,13 +267,39 @@ def main(args, pool, filtered=False):
 
     # Use multiprocessing to partition the gneome in windows and generate the summary files in parallel processes
     #pool = mp.Pool(processes=min(args.cpu, len(chroms)))
-    makeGraphFile_partial = partial(makeGraphFile, args, filtered)
-    makeGraphFile_result = pool.starmap(makeGraphFile_partial, list_of_args)
+    if filtered:
+        makeGraphFile_partial = partial(makeGraphFile, args, filtered)
+        makeGraphFile_result = chrom_scheduler.chrom_map(pool, makeGraphFile_partial, list_of_args, args, star=True)
+    else:
+        # Long chromosomes are counted in shards, which are joined once all shards are done
+        shard_results = chrom_scheduler.shard_map(pool, partial(count_shard, args), args)
+        join_graph_shards_partial = partial(join_graph_shards, args)
+        makeGraphFile_result = chrom_scheduler.chrom_map(pool, join_graph_shards_partial,
+                                                         [chrom_args + (results,) for chrom_args, results in
+                                                          zip(list_of_args, shard_results)], args, star=True)
     #pool.close()
 
     total_tag_count = 0
+    total_rejected_count = 0
     for result in makeGraphFile_result:
         total_tag_count += result[0]
+        total_rejected_count += result[2]
         print(result[1])
+    if args.cache_dir is not None and not filtered:
+        print_index_status(args, [result[3] for result in makeGraphFile_result])
+
+    # Gather the illegitimate reads of all chromosomes into one BED file
+    if args.rejected_reads and not filtered:
+        file = args.treatment_file.replace('.bed', '')
+        outfile_path = os.path.join(args.output_directory, file + '-rejected.bed')
+        with open(outfile_path, 'w') as outfile:
+            for chrom in chroms:
+                reject_file = file + '_' + chrom + '_rejected.bed'
+                if os.path.exists(reject_file):
+                    with open(reject_file) as infile:
+                        shutil.copyfileobj(infile, outfile)
+        print("Illegitimate reads ignored:", total_rejected_count, "(written to " + outfile_path + ")")
+    elif args.verbose and total_rejected_count > 0:
+        print("Illegitimate reads ignored:", total_rejected_count)
 
     return (total_tag_count)
@@ -1,56 +1,20 @@
 # Author: 2022 STJUDE Modupeore Adetunji
 
-# Separate bed file to individual chromosomes
+# Separate bed file to individual chromosomes and remove redundant fragments
 
-import os
-import re
-import sys
-import subprocess
-from functools import partial
-import numpy as np
+from sicer.src import demultiplex_reads_by_chrom
+from sicer.src import remove_redundant_reads
 
-def separate_bedpe_chroms(file, chrom):
-    file_name = os.path.basename(file)
-    file_name = file_name.replace('.bed', '')
+'''Separates the fragments of every chromosome and removes the fragments beyond the first cutoff copies of the same
+    start, end and strand, which are PCR duplicates. The fragments are filtered as soon as they are read back from
+    the demultiplexed file, shard by shard for long chromosomes, by remove_redundant_reads.filter_reads_by_shard.'''
 
-    print_return = ""
+def main(args, file, pool, with_names=False):
+    cutoff = args.redundancy_threshold
 
-    match = chrom + "[[:space:]]"
-    individual_bed = subprocess.Popen(['grep', match, file], stdout=subprocess.PIPE)
-    bed_reads = str(individual_bed.communicate()[0], 'utf-8').splitlines()
-    read_dtype = np.dtype([('chrom', 'U6'), ('start', np.int32), ('end', np.int32), ('name', 'U20'), ('score', np.int32), ('strand', 'U1')])
-    processed_reads = np.empty(len(bed_reads), dtype=read_dtype)
+    # Separate all reads by chromosome in a single pass over the file
+    demultiplex_reads_by_chrom.main(args, file, True, pool, with_names)
 
-    reads_count = 0
-    for i, reads in enumerate(bed_reads):
-        reads = re.split('\t', reads)
-        if len(reads) < 6:
-            sys.stderr.write(
-                "Error: Input BED files must have the first six fields. Check " + file_name + " to see if it has the following fields: chrom, chromStart, chromEnd, name, score, and strand\n")
-            sys.exit(1)
-        reads[1] = int(reads[1])
-        reads[2] = int(reads[2])
-        processed_reads[i] = tuple(reads)
-        reads_count += 1
+    results_count = remove_redundant_reads.filter_reads_by_shard(args, file, cutoff, with_names, True, pool)
 
-    print_return += ('{:<5s}{:^25d}'.format(chrom, reads_count))
-    name_for_save = file_name + "_" + chrom + ".npy"
-    np.save(name_for_save, processed_reads)
-
-    return (print_return, reads_count)
-
-def main(args, file, pool):
-    chroms = args.species_chroms
-
-    separate_chroms_partial = partial(separate_bedpe_chroms, file)
-    results_count = pool.map(separate_chroms_partial, chroms)
-
-    total_read_count = 0
-    print(('-' *30))
-    print(('{:<5s}{:^25s}'.format("chrom", "Total reads")))
-    print(('-' *30))
-    for result in results_count:
-        print(result[0])
-        total_read_count += result[1]
-
-    return total_read_count
+    return remove_redundant_reads.print_redundancy_table(results_count)
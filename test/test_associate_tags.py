@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# P-values of islands without control reads, for libraries large enough that the expected count of an island
+# overflows 32-bit integers when computed in the type of its coordinates.
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+import scipy.stats
+
+from sicer.lib import bed_parser
+from sicer.src import associate_tags_with_chip_and_control_w_fc_q
+
+GENOME_SIZE = 3.0e9
+
+
+class AssociateTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def test_large_control_library(self):
+        # Islands with 32-bit coordinates, as found in graph files built from 32-bit tag positions
+        islands = np.empty((2, 4), dtype=object)
+        islands[0] = ('chr1', np.int32(10000), np.int32(11999), 30.0)
+        islands[1] = ('chr1', np.int32(50000), np.int32(50999), 20.0)
+        np.save('treatment_chr1_graph.npy', islands)
+        treatment = np.zeros(25, dtype=bed_parser.read_dtype)
+        treatment['start'] = np.arange(25) * 40 + 10500
+        treatment['end'] = treatment['start'] + 50
+        treatment['strand'] = bed_parser.PLUS
+        np.save('treatment_chr1.npy', treatment)
+        np.save('control_chr1.npy', np.zeros(0, dtype=bed_parser.read_dtype))
+
+        control_library_size = 1800000
+        scaling_factor = 1.0
+        # 2000 * control_library_size exceeds 2**31
+        self.assertGreater(2000 * control_library_size, 2**31)
+        args = argparse.Namespace(treatment_file='treatment.bed', control_file='control.bed', fragment_size=150)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            pvalue_file = associate_tags_with_chip_and_control_w_fc_q.associate_tag_count_to_regions(
+                args, scaling_factor, control_library_size, GENOME_SIZE, 'chr1')
+        pvalues = np.load(pvalue_file)
+
+        average = min(0.25, 2000 * control_library_size / GENOME_SIZE) * scaling_factor
+        self.assertFalse(np.isnan(pvalues).any())
+        self.assertAlmostEqual(pvalues[0], scipy.stats.poisson.sf(25, average))
+        self.assertEqual(pvalues[1], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
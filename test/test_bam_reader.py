@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Decoding of small BAM files written by the tests themselves, for single-end reads
+# and for paired-end fragments.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from sicer.lib import bam_reader
+
+REFERENCES = [('chr1', 1000000), ('chr2', 1000000)]
+
+# CIGAR operation codes
+MATCH = 0
+DELETION = 2
+
+
+def bgzf_block(data):
+    '''Returns data compressed as one BGZF member'''
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4sI2BH2sHH', b'\x1f\x8b\x08\x04', 0, 0, 255, 6, b'BC', 2, 18 + len(deflated) + 8 - 1)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def bam_record(name, ref_id, pos, flag, cigar=(), mapq=30, next_ref_id=-1, next_pos=-1, template_length=0):
+    '''Returns an alignment record. cigar is a sequence of (operation, length) pairs.'''
+    read_name = name.encode() + b'\x00'
+    seq_length = sum(length for operation, length in cigar if operation != DELETION)
+    body = struct.pack('<iiBBHHHiiii', ref_id, pos, len(read_name), mapq, 4680, len(cigar), flag, seq_length,
+                       next_ref_id, next_pos, template_length)
+    body += read_name
+    body += b''.join(struct.pack('<I', length << 4 | operation) for operation, length in cigar)
+    body += b'\x11' * ((seq_length + 1) // 2) + b'\x1e' * seq_length
+    return struct.pack('<i', len(body)) + body
+
+
+def write_bam(path, records):
+    header_text = b'@HD\tVN:1.6\tSO:coordinate\n'
+    header = b'BAM\x01' + struct.pack('<i', len(header_text)) + header_text + struct.pack('<i', len(REFERENCES))
+    for name, length in REFERENCES:
+        header += struct.pack('<i', len(name) + 1) + name.encode() + b'\x00' + struct.pack('<i', length)
+    with open(path, 'wb') as outfile:
+        outfile.write(bgzf_block(header))
+        outfile.write(bgzf_block(b''.join(records)))
+        # End-of-file marker
+        outfile.write(bgzf_block(b''))
+
+
+def read_all(path, chroms, paired_end=False, with_names=False):
+    '''Returns the reads of the BAM file as a list of (chrom, start, end, strand[, name, score]) tuples'''
+    reads = []
+    for chrom_index, block in bam_reader.read_bam_blocks(path, chroms, paired_end, with_names):
+        for i, read in zip(chrom_index, block):
+            fields = (chroms[i], int(read['start']), int(read['end']), chr(read['strand']))
+            if with_names:
+                fields += (read['name'].decode(), int(read['score']))
+            reads.append(fields)
+    return reads
+
+
+class BamReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam_file = os.path.join(self.temp_dir, 'reads.bam')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_single_end(self):
+        write_bam(self.bam_file, [
+            bam_record('a', 0, 100, 0, [(MATCH, 50)], mapq=20),
+            bam_record('b', 0, 200, bam_reader.FLAG_REVERSE, [(MATCH, 30), (DELETION, 5), (MATCH, 10)]),
+            bam_record('c', 0, 300, bam_reader.FLAG_PAIRED | bam_reader.FLAG_FIRST_MATE, [(MATCH, 25)]),
+            bam_record('unmapped', -1, -1, bam_reader.FLAG_UNMAPPED),
+            bam_record('d', 1, 400, 0, [(MATCH, 36)]),
+        ])
+        self.assertEqual(read_all(self.bam_file, ['chr1', 'chr2']),
+                         [('chr1', 100, 150, '+'), ('chr1', 200, 245, '-'), ('chr1', 300, 325, '+'),
+                          ('chr2', 400, 436, '+')])
+        # Reads on chromosomes that are not asked for are skipped; paired reads get the suffix of their mate
+        self.assertEqual(read_all(self.bam_file, ['chr1'], with_names=True),
+                         [('chr1', 100, 150, '+', 'a', 20), ('chr1', 200, 245, '-', 'b', 30),
+                          ('chr1', 300, 325, '+', 'c/1', 30)])
+
+    def test_paired_end(self):
+        paired = bam_reader.FLAG_PAIRED | 0x2
+        first = paired | bam_reader.FLAG_FIRST_MATE
+        second = paired | bam_reader.FLAG_SECOND_MATE
+        write_bam(self.bam_file, [
+            # Mates at different positions: the leftmost one has the positive template length
+            bam_record('a', 0, 100, first | bam_reader.FLAG_MATE_REVERSE, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=300, template_length=250),
+            # Mates at the same position, both with a positive template length
+            bam_record('b', 0, 500, second | bam_reader.FLAG_MATE_REVERSE, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=500, template_length=80),
+            bam_record('b', 0, 500, first | bam_reader.FLAG_REVERSE, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=500, template_length=80),
+            # Mates at the same position, both with a negative template length
+            bam_record('c', 0, 700, first, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=700, template_length=-90),
+            bam_record('c', 0, 700, second | bam_reader.FLAG_REVERSE, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=700, template_length=-90),
+            bam_record('a', 0, 300, second | bam_reader.FLAG_REVERSE, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=100, template_length=-250),
+            # The mate of a pair is unmapped
+            bam_record('d', 0, 900, first | bam_reader.FLAG_MATE_UNMAPPED, [(MATCH, 50)],
+                       next_ref_id=0, next_pos=900),
+            # The mates of a pair are on different chromosomes
+            bam_record('e', 0, 950, first, [(MATCH, 50)], next_ref_id=1, next_pos=100),
+            bam_record('f', 1, 100, second, [(MATCH, 50)], next_ref_id=0, next_pos=950),
+        ])
+        self.assertEqual(read_all(self.bam_file, ['chr1', 'chr2'], paired_end=True, with_names=True),
+                         [('chr1', 100, 350, '+', 'a', 30), ('chr1', 500, 580, '-', 'b', 30),
+                          ('chr1', 700, 790, '+', 'c', 30)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Parsing of BED blocks, compared with a line by line str.split parser.
+
+import contextlib
+import io
+import random
+import tracemalloc
+import unittest
+
+import numpy as np
+
+from sicer.lib import bed_parser
+
+CHROMS = ['chr1', 'chr2', 'chrX', 'chr10']
+
+
+def split_parse(text, chroms, with_names=False):
+    '''Parses BED text line by line. Returns (chrom_index, reads) like bed_parser.parse_bed_block.'''
+    chrom_index = []
+    rows = []
+    for line in text.split('\n'):
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        fields = line.split('\t')
+        if fields[0] not in chroms:
+            continue
+        if len(fields) < 6:
+            raise ValueError("missing fields")
+        row = (int(fields[1]), int(fields[2]), ord(fields[5][:1] or '\x00'))
+        if with_names:
+            row += (fields[3][:20].encode(), int(fields[4]))
+        chrom_index.append(chroms.index(fields[0]))
+        rows.append(row)
+    return (np.array(chrom_index, dtype=np.intp), np.array(rows, dtype=bed_parser.get_read_dtype(with_names)))
+
+
+def parse_text(text, chroms, with_names=False):
+    '''Parses BED text with bed_parser, regrouped into blocks that end at a line boundary'''
+    chrom_index = [np.zeros(0, dtype=np.intp)]
+    reads = [np.zeros(0, dtype=bed_parser.get_read_dtype(with_names))]
+    for block in bed_parser.line_blocks([text.encode()]):
+        block_index, block_reads = bed_parser.parse_bed_block(block, chroms, 'test.bed', with_names=with_names)
+        chrom_index.append(block_index)
+        reads.append(block_reads)
+    return (np.concatenate(chrom_index), np.concatenate(reads))
+
+
+def random_line(rng):
+    chrom = rng.choice(CHROMS + ['chrUn_KI270302v1', 'chrY', 'chr1_random'])
+    start = rng.randint(-1000, 10**9)
+    end = start + rng.randint(0, 500)
+    name = ''.join(rng.choice('abcdefghij:/_0123456789') for i in range(rng.randint(1, 30)))
+    fields = [chrom, str(start), str(end), name, str(rng.randint(0, 1000)), rng.choice('+-')]
+    fields += ['extra'] * rng.randint(0, 3)
+    return '\t'.join(fields)
+
+
+class BedParserTest(unittest.TestCase):
+
+    def assert_same_as_split(self, text, chroms=CHROMS, with_names=False):
+        expected_index, expected_reads = split_parse(text, chroms, with_names)
+        chrom_index, reads = parse_text(text, chroms, with_names)
+        np.testing.assert_array_equal(chrom_index, expected_index)
+        np.testing.assert_array_equal(reads, expected_reads)
+
+    def assert_exits(self, text):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                parse_text(text, CHROMS)
+
+    def test_random_lines(self):
+        rng = random.Random(1)
+        for case in range(20):
+            lines = [random_line(rng) for i in range(rng.randint(0, 200))]
+            text = '\n'.join(lines) + rng.choice(['\n', ''])
+            self.assert_same_as_split(text)
+            self.assert_same_as_split(text, with_names=True)
+
+    def test_negative_coordinates(self):
+        self.assert_same_as_split('chr1\t-5\t-1\tr1\t0\t+\nchr2\t-100\t20\tr2\t3\t-\n', with_names=True)
+
+    def test_non_integer_coordinates(self):
+        self.assert_exits('chr1\t10\t20\tr1\t0\t+\nchr1\t1.5\t20\tr2\t0\t+\n')
+        self.assert_exits('chr1\t10\t2e3\tr1\t0\t+\n')
+        self.assert_exits('chr1\t\t20\tr1\t0\t+\n')
+
+    def test_missing_strand(self):
+        self.assert_exits('chr1\t10\t20\tr1\t0\t+\nchr1\t10\t20\tr2\t0\n')
+        # Lines of other chromosomes are skipped before their fields are checked
+        self.assert_same_as_split('chr1\t10\t20\tr1\t0\t+\nchrM\t10\t20\n')
+
+    def test_crlf_line_endings(self):
+        self.assert_same_as_split('chr1\t10\t20\tr1\t0\t+\r\nchr2\t30\t40\tr2\t5\t-\r\n\r\n', with_names=True)
+
+    def test_no_trailing_newline(self):
+        self.assert_same_as_split('chr1\t10\t20\tr1\t0\t+\nchrX\t30\t40\tr2\t5\t-')
+        self.assert_same_as_split('chr1\t10\t20\tr1\t0\t+\r\nchrX\t30\t40\tr2\t5\t-\r')
+
+    def test_long_header_line(self):
+        track = 'track name=reads description="' + 'x' * 300 + '"'
+        lines = [random_line(random.Random(i)) for i in range(20000)]
+        text = '\n'.join(['#' + 'c' * 500, track] + lines) + '\n'
+        self.assert_same_as_split(text)
+
+        # The header lines do not widen the chromosome field of the whole block
+        peaks = []
+        for block in (text.encode(), ('\n'.join(lines) + '\n').encode()):
+            tracemalloc.start()
+            try:
+                bed_parser.parse_bed_block(block, CHROMS, 'test.bed')
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        self.assertLess(peaks[0], 2 * peaks[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Redundancy removal compared with the original loop over the reads sorted by strand, start and end.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from sicer.lib import bed_parser
+from sicer.src import remove_redundant_reads
+
+CHROM = 'chr1'
+
+
+def baseline_remove(reads, cutoff):
+    '''Returns the redundancy table row and the retained reads given by the original implementation'''
+    sorted_reads = np.sort(reads, order=['strand', 'start', 'end'])
+    # The first read that is not on the plus strand, or 0 if there is none
+    mark = 0
+    for i in range(len(sorted_reads)):
+        if sorted_reads[i]['strand'] != bed_parser.PLUS:
+            mark = i
+            break
+    counts = []
+    kept = []
+    for begin, end in ((0, mark), (mark, len(sorted_reads))):
+        current_start = 0
+        current_end = 0
+        current_count = 1
+        retained = 0
+        for i in range(begin, end):
+            start = sorted_reads[i]['start']
+            read_end = sorted_reads[i]['end']
+            if start != current_start or read_end != current_end:
+                current_start = start
+                current_end = read_end
+                current_count = 1
+                retained += 1
+                kept.append(i)
+            else:
+                current_count += 1
+                if current_count <= cutoff:
+                    retained += 1
+                    kept.append(i)
+        counts += [end - begin, retained]
+    row = '{:<5s}{:^25d}{:^25d}{:^25d}{:^25d}'.format(CHROM, *counts)
+    return (row, sorted_reads[kept])
+
+
+def random_reads(rng, num_reads, with_names=False, strands=b'+-'):
+    '''Returns reads with many copies of the same (start, end, strand), including reads at (0, 0)'''
+    reads = np.zeros(num_reads, dtype=bed_parser.get_read_dtype(with_names))
+    num_positions = max(num_reads // 3, 1)
+    positions = [(0, 0)] + [(start, start + rng.randint(1, 40)) for start in
+                            (rng.randint(0, 5000) for i in range(num_positions))]
+    for i in range(num_reads):
+        reads[i]['start'], reads[i]['end'] = rng.choice(positions)
+        reads[i]['strand'] = rng.choice(strands)
+        if with_names:
+            reads[i]['name'] = rng.choice([b'a', b'b', b'c'])
+            reads[i]['score'] = rng.randint(0, 2)
+    return reads
+
+
+def sorted_by_start(reads):
+    return reads[np.argsort(reads['start'], kind='stable')]
+
+
+def blocks_of(reads, block_size):
+    return (reads[i:i + block_size] for i in range(0, len(reads), block_size))
+
+
+class RemoveRedundantReadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.temp_dir, 'reads')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def saved_reads(self):
+        return np.load(self.file + '_' + CHROM + '.npy')
+
+    def assert_same_as_baseline(self, reads, cutoff, result, in_order):
+        '''Checks the result and the saved reads against baseline_remove. Reads without names that were not
+            sorted may be saved in any order.'''
+        row, expected = baseline_remove(reads, cutoff)
+        self.assertEqual(remove_redundant_reads.redundancy_row(CHROM, result[0]), row)
+        self.assertEqual(result[1], len(expected))
+        saved = self.saved_reads()
+        if in_order:
+            np.testing.assert_array_equal(saved, expected)
+        else:
+            np.testing.assert_array_equal(np.sort(saved), np.sort(expected))
+
+    def test_strand_broken_remove(self):
+        rng = random.Random(1)
+        for case in range(60):
+            with_names = case % 2 == 1
+            strands = rng.choice([b'+-', b'+', b'-', b'+-.'])
+            reads = random_reads(rng, rng.randint(0, 300), with_names, strands)
+            if case % 3 == 0:
+                reads = sorted_by_start(reads)
+            cutoff = rng.randint(1, 3)
+            result = remove_redundant_reads.strand_broken_remove(CHROM, cutoff, self.file, reads)
+            # Only the hash table used for unsorted reads without names keeps the input order
+            self.assert_same_as_baseline(reads, cutoff, result, with_names or strands == b'+-.')
+
+    def test_stream_sorted_remove(self):
+        rng = random.Random(2)
+        for case in range(60):
+            with_names = case % 2 == 1
+            reads = sorted_by_start(random_reads(rng, rng.randint(0, 300), with_names, rng.choice([b'+-', b'+', b'-'])))
+            cutoff = rng.randint(1, 3)
+            read_blocks = blocks_of(reads, rng.randint(1, 50))
+            result = remove_redundant_reads.stream_sorted_remove(CHROM, cutoff, self.file, read_blocks, with_names)
+            self.assert_same_as_baseline(reads, cutoff, result, True)
+
+    def test_stream_sorted_remove_falls_back(self):
+        rng = random.Random(3)
+        reads = random_reads(rng, 200)
+        self.assertIsNone(remove_redundant_reads.stream_sorted_remove(CHROM, 1, self.file, blocks_of(reads, 30)))
+        reads = sorted_by_start(random_reads(rng, 200, strands=b'+-.'))
+        self.assertIsNone(remove_redundant_reads.stream_sorted_remove(CHROM, 1, self.file, blocks_of(reads, 30)))
+        # The spill files are removed
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_filter_read_blocks_in_sorted_runs(self):
+        rng = random.Random(4)
+        write_sorted_run = remove_redundant_reads.write_sorted_run
+        for case in range(40):
+            with_names = case % 2 == 1
+            reads = random_reads(rng, rng.randint(100, 400), with_names, rng.choice([b'+-', b'+', b'-']))
+            cutoff = rng.randint(1, 3)
+            block_size = rng.randint(1, 30)
+            max_reads = rng.randint(1, 60)
+            with mock.patch.object(remove_redundant_reads, 'write_sorted_run', wraps=write_sorted_run) as runs:
+                result = remove_redundant_reads.filter_read_blocks(lambda: blocks_of(reads, block_size), CHROM, cutoff,
+                                                                   self.file, with_names, max_reads)
+            # The unsorted reads do not fit in max_reads, so that they are sorted in runs on disk and merged
+            self.assertGreater(runs.call_count, 1)
+            self.assert_same_as_baseline(reads, cutoff, result, True)
+            self.assertEqual(sorted(os.listdir(self.temp_dir)), ['reads_chr1.npy'])
+
+    def test_filter_read_blocks_in_memory(self):
+        rng = random.Random(5)
+        for case in range(20):
+            with_names = case % 2 == 1
+            reads = random_reads(rng, rng.randint(0, 300), with_names)
+            if case % 4 == 0:
+                reads = sorted_by_start(reads)
+            result = remove_redundant_reads.filter_read_blocks(lambda: blocks_of(reads, 25), CHROM, 2, self.file,
+                                                               with_names, 1000)
+            self.assert_same_as_baseline(reads, 2, result, with_names or case % 4 == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Tag indexes saved for a library, and their invalidation once the library changes.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sicer.lib import tag_index
+
+CHROM_LENGTH = 10000
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.library = os.path.join(self.temp_dir, 'treatment.bed')
+        with open(self.library, 'w') as outfile:
+            outfile.write('chr1\t100\t125\tr1\t0\t+\nchr1\t5000\t5025\tr2\t0\t-\n')
+        self.index_file = tag_index.index_file_name(self.temp_dir, self.library, 150, 1, 'chr1')
+        positions = [175, 4950, 4999, 9999]
+        self.counts = tag_index.merge_bins([tag_index.bin_counts(positions)], CHROM_LENGTH)
+        self.stats = [4, 4, 0]
+        self.assertTrue(tag_index.save_index(self.index_file, self.library, self.counts, CHROM_LENGTH, self.stats))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assert_invalid(self, chrom_length=CHROM_LENGTH):
+        self.assertIsNone(tag_index.load_index(self.index_file, self.library, chrom_length))
+        self.assertFalse(tag_index.is_valid_index(self.index_file, self.library, chrom_length))
+
+    def test_load_index(self):
+        self.assertTrue(tag_index.is_valid_index(self.index_file, self.library, CHROM_LENGTH))
+        cumulative, stats = tag_index.load_index(self.index_file, self.library, CHROM_LENGTH)
+        np.testing.assert_array_equal(cumulative, tag_index.cumulative_counts(self.counts))
+        self.assertEqual(stats, self.stats)
+        window_starts, counts = tag_index.window_counts(cumulative, CHROM_LENGTH, 200)
+        self.assertEqual(counts.tolist(), [1] + [0] * 23 + [2] + [0] * 24 + [1])
+
+    def test_modification_time_changed(self):
+        stat = os.stat(self.library)
+        os.utime(self.library, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assert_invalid()
+
+    def test_size_changed(self):
+        stat = os.stat(self.library)
+        with open(self.library, 'a') as outfile:
+            outfile.write('chr1\t7000\t7025\tr3\t0\t+\n')
+        # Same modification time, so that only the size tells the libraries apart
+        os.utime(self.library, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assert_invalid()
+
+    def test_chrom_length_changed(self):
+        self.assert_invalid(CHROM_LENGTH + 50)
+
+    def test_missing_index(self):
+        os.remove(self.index_file)
+        self.assert_invalid()
+
+
+if __name__ == '__main__':
+    unittest.main()